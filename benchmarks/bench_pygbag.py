@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+"""
+reproducible benchmarks for pygbag packaging and test server hot paths.
+
+    python3 benchmarks/bench_pygbag.py --files 500 --size 64 --output results.json
+
+a synthetic app tree is generated from a seed, so runs with same arguments
+can be compared across pygbag versions. Results are printed as JSON.
+"""
+
+import sys
+import os
+import io
+import json
+import time
+import zlib
+import struct
+import random
+import shutil
+import asyncio
+import argparse
+import platform
+import tempfile
+import threading
+import contextlib
+import statistics
+import urllib.request
+from functools import partial
+from pathlib import Path
+
+# run from a source checkout without installing
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import pygbag
+from pygbag import pack
+from pygbag import optimizing
+
+
+DEFAULT_MIX = "png=0.3,ogg=0.2,py=0.3,bin=0.2"
+
+PY_TEMPLATE = '''"""
+module {n} docstring, long enough to be representative of real code
+"""
+import sys
+
+# comment {n}
+
+
+class Thing{n}:
+    """class docstring"""
+
+    def __init__(self, value):
+        # keep value
+        self.value = value
+
+    def compute(self, x):
+        """method docstring"""
+        assert x is not None
+        return [self.value * i + x for i in range({n} % 50 + 10)]
+
+
+def main():
+    return Thing{n}({n}).compute(1)
+'''
+
+MAIN_PY = '''import asyncio
+
+
+async def main():
+    while True:
+        await asyncio.sleep(0)
+
+
+asyncio.run(main())
+'''
+
+
+def randbytes(rng, size):
+    # random.Random.randbytes is 3.9+
+    return rng.getrandbits(size * 8).to_bytes(size, "little")
+
+
+def png_bytes(rng, size):
+    # a valid rgb png, mixing flat areas and noise so it compresses like real art
+    width = max(8, int((size / 3) ** 0.5))
+    rows = []
+    for y in range(width):
+        if y % 4:
+            row = bytes((x * 7 + y) & 0xFF for x in range(width * 3))
+        else:
+            row = randbytes(rng, width * 3)
+        rows.append(b"\0" + row)
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    header = struct.pack(">IIBBBBB", width, width, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(b"".join(rows))) + chunk(b"IEND", b"")
+
+
+def make_tree(root, files, size_kib, mix, seed):
+    rng = random.Random(seed)
+    root = Path(root)
+    root.mkdir(parents=True, exist_ok=True)
+    (root / "main.py").write_text(MAIN_PY)
+
+    kinds = []
+    weights = []
+    for item in mix.split(","):
+        kind, weight = item.split("=")
+        kinds.append(kind.strip())
+        weights.append(float(weight))
+
+    total = 0
+    for n in range(files):
+        kind = rng.choices(kinds, weights)[0]
+        folder = root / f"d{n % 16}" / f"s{n % 5}"
+        folder.mkdir(parents=True, exist_ok=True)
+        size = max(64, int(rng.expovariate(1 / (size_kib * 1024))))
+        if kind == "png":
+            data = png_bytes(rng, size)
+        elif kind == "py":
+            data = PY_TEMPLATE.format(n=n).encode() * max(1, size // 2048)
+        elif kind == "ogg":
+            data = b"OggS" + randbytes(rng, size)
+        else:
+            # half random, half repeated : compressible blobs
+            data = randbytes(rng, size // 2) + bytes(size - size // 2)
+        (folder / f"f{n}.{kind}").write_bytes(data)
+        total += len(data)
+    return total
+
+
+def make_stub_tools(folder):
+    # stand-ins for pngquant and ffmpeg, only copying files so timings measure pygbag
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    stubs = {
+        "pngquant": """
+import sys, shutil
+if "--version" in sys.argv:
+    print("0.0.0 (benchmark stub)")
+    raise SystemExit(0)
+shutil.copyfile(sys.argv[-1], sys.argv[sys.argv.index("--output") + 1])
+""",
+        "ffmpeg": """
+import sys, shutil
+if "-version" in sys.argv:
+    print("ffmpeg version benchmark stub")
+    raise SystemExit(0)
+shutil.copyfile(sys.argv[sys.argv.index("-i") + 1], sys.argv[-1])
+""",
+    }
+    for name, code in stubs.items():
+        stub = folder / name
+        stub.write_text(f"#!{sys.executable}{code}")
+        stub.chmod(0o755)
+    return folder
+
+
+@contextlib.contextmanager
+def argv(*flags):
+    # pygbag stages read some options straight from sys.argv
+    saved = list(sys.argv)
+    sys.argv[:] = [sys.argv[0], *flags]
+    try:
+        yield
+    finally:
+        sys.argv[:] = saved
+
+
+@contextlib.contextmanager
+def quiet():
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+def measure(name, fn, repeat, setup=None, **extra):
+    runs = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        t0 = time.perf_counter()
+        with quiet():
+            fn()
+        runs.append(time.perf_counter() - t0)
+    result = {
+        "name": name,
+        "runs": repeat,
+        "median": statistics.median(runs),
+        "min": min(runs),
+        "max": max(runs),
+    }
+    result.update(extra)
+    print(f"{name:<24} median {result['median']:.4f}s min {result['min']:.4f}s", file=sys.stderr)
+    return result
+
+
+def bench_archive(app, build, repeat, jobs, total):
+    results = []
+    web = build / "web"
+
+    def cold():
+        shutil.rmtree(build, ignore_errors=True)
+        web.mkdir(parents=True)
+
+    def run():
+        asyncio.run(pack.archive("bench.apk", app, web, jobs=jobs))
+
+    with argv("--no_opt"):
+        results.append(measure("archive_cold", run, repeat, setup=cold, bytes=total, jobs=jobs))
+        results.append(measure("archive_warm", run, repeat, bytes=total, jobs=jobs))
+        results.append(measure("stream_pack_replay", pack.stream_pack_replay, repeat, bytes=total, jobs=jobs))
+        apk = web / "bench.apk"
+        results[-1]["apk_bytes"] = apk.stat().st_size
+
+    with argv("--no_opt", "--html"):
+        results.append(measure("html_embed", run, repeat, bytes=total))
+        results[-1]["html_bytes"] = (web / "bench.html").stat().st_size
+
+    return results
+
+
+def bench_optimize(app, build, repeat, jobs):
+    if sys.platform != "linux":
+        # optimizer only converts on linux
+        return []
+
+    tools = make_stub_tools(build / "stubs")
+    cache = build / "bench-opt-cache"
+    rules = pack.Rules(app)
+    assets = [asset for folder, found in pack.gather(app, rules=rules) for asset in found]
+
+    def cold():
+        shutil.rmtree(cache, ignore_errors=True)
+
+    def run():
+        for asset in optimizing.optimize(app, assets, jobs=jobs, cache=cache):
+            pass
+
+    saved = os.environ["PATH"]
+    os.environ["PATH"] = f"{tools}{os.pathsep}{saved}"
+    optimizing.version.cache_clear()
+    try:
+        with argv():
+            results = [
+                measure("optimize_cold", run, repeat, setup=cold, files=len(assets), jobs=jobs),
+                measure("optimize_warm", run, repeat, files=len(assets), jobs=jobs),
+            ]
+    finally:
+        os.environ["PATH"] = saved
+        optimizing.version.cache_clear()
+    return results
+
+
+def bench_server(app, build, repeat, clients, requests):
+    from pygbag import testserver
+
+    web = build / "web"
+    (web / "index.html").write_text(f'<html><script src="https://pygame-web.github.io/pythons.js"></script></html>')
+    py = next(app.rglob("*.py"))
+    shutil.copyfile(py, web / "sample.py")
+    blob = max((path for path in app.rglob("*.bin")), key=lambda path: path.stat().st_size, default=None)
+    if blob:
+        shutil.copyfile(blob, web / "large.bin")
+
+    testserver.CACHE = build / "web-cache"
+    testserver.CACHE.mkdir(exist_ok=True)
+    testserver.CDN = "https://pygame-web.github.io"
+    testserver.PROXY = "http://localhost:8000/"
+    testserver.BCDN = testserver.CDN.encode()
+    testserver.BPROXY = testserver.PROXY.encode()
+    testserver.VERB = False
+
+    handler = partial(testserver.CodeHandler, directory=str(web))
+    handler.func.log_message = lambda *argv: None
+    # same protocol as code_server()
+    handler.func.protocol_version = "HTTP/1.1"
+
+    class Server(testserver.ThreadingHTTPServer):
+        # stock backlog of 5 drops connects above that many clients, they then wait for the 1s SYN retry
+        request_queue_size = max(64, clients * 2)
+
+    httpd = Server(("127.0.0.1", 0), handler)
+    port = httpd.socket.getsockname()[1]
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+
+    results = []
+    try:
+        for path in ("index.html", "sample.py", "large.bin", "bench.apk"):
+            if not (web / path).is_file():
+                continue
+            url = f"http://127.0.0.1:{port}/{path}"
+            received = []
+
+            def client():
+                for _ in range(requests):
+                    with urllib.request.urlopen(url) as response:
+                        received.append(len(response.read()))
+
+            def run():
+                received.clear()
+                threads = [threading.Thread(target=client) for _ in range(clients)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+
+            result = measure(f"server_{path}", run, repeat, clients=clients, requests=clients * requests)
+            result["requests_per_s"] = clients * requests / result["median"]
+            result["bytes_per_s"] = sum(received) / result["median"]
+            results.append(result)
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="pygbag packaging and serving benchmarks")
+    parser.add_argument("--files", type=int, default=200, help="number of synthetic assets [default:200]")
+    parser.add_argument("--size", type=int, default=32, help="mean asset size in KiB [default:32]")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"asset kinds and weights [default:{DEFAULT_MIX}]")
+    parser.add_argument("--seed", type=int, default=1, help="random seed for the synthetic tree [default:1]")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per benchmark [default:3]")
+    parser.add_argument("--jobs", type=int, default=0, help="pygbag --jobs value [default:0]")
+    parser.add_argument("--clients", type=int, default=8, help="concurrent http clients [default:8]")
+    parser.add_argument("--requests", type=int, default=20, help="requests per client [default:20]")
+    parser.add_argument("--only", default="archive,optimize,server", help="benchmarks groups to run")
+    parser.add_argument("--workdir", default=None, help="keep generated files there instead of a temp folder")
+    parser.add_argument("--output", default=None, help="write JSON results to that file")
+    args = parser.parse_args()
+
+    pygbag.config = {"cdn": "https://pygame-web.github.io/archives/0.0/"}
+
+    with contextlib.ExitStack() as stack:
+        if args.workdir:
+            work = Path(args.workdir).resolve()
+            shutil.rmtree(work, ignore_errors=True)
+        else:
+            work = Path(stack.enter_context(tempfile.TemporaryDirectory(prefix="pygbag-bench-")))
+
+        app = work / "app"
+        build = app / "build"
+        total = make_tree(app, args.files, args.size, args.mix, args.seed)
+        (build / "web").mkdir(parents=True, exist_ok=True)
+
+        groups = args.only.split(",")
+        results = []
+        if "archive" in groups:
+            results.extend(bench_archive(app, build, args.repeat, args.jobs, total))
+        if "optimize" in groups:
+            results.extend(bench_optimize(app, build, args.repeat, args.jobs))
+        if "server" in groups:
+            results.extend(bench_server(app, build, args.repeat, args.clients, args.requests))
+
+    report = {
+        "pygbag": pygbag.__version__,
+        "python": platform.python_version(),
+        "platform": sys.platform,
+        "cpus": os.cpu_count(),
+        "time": int(time.time()),
+        "params": {
+            "files": args.files,
+            "size_kib": args.size,
+            "mix": args.mix,
+            "seed": args.seed,
+            "repeat": args.repeat,
+            "jobs": args.jobs,
+            "bytes": total,
+        },
+        "results": results,
+    }
+
+    text = json.dumps(report, indent=1)
+    if args.output:
+        Path(args.output).write_text(text)
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,7 @@
 import asyncio
 import sys
 
-# rmtree msg on win32
-import warnings
-
-# import os
+import os
 import argparse
 
 
@@ -21,14 +18,16 @@ import pygbag
 
 from . import pack
 from . import web
+from . import profiling
+from . import compressing
+from . import caching
+from . import prefetching
 
 
 devmode = "--dev" in sys.argv
 
 DEFAULT_SCRIPT = "main.py"
 CACHE_ROOT = Path("build")
-CACHE_PATH = CACHE_ROOT / "web-cache"
-CACHE_VERSION = CACHE_ROOT / "version.txt"
 CACHE_APP = CACHE_ROOT / "web"
 
 cdn_dot = __version__.split(".")
@@ -109,31 +108,11 @@ def set_args(program):
 
 
 def cache_check(app_folder, devmode=False):
-    global CACHE_PATH, CACHE_APP, __version__
-
-    version_file = app_folder / CACHE_VERSION
-
-    clear_cache = False
-
-    # always clear the cache in devmode, because cache source is local and changes a lot
-    if devmode:
-        print("103: DEVMODE: clearing cache")
-        clear_cache = True
-    elif version_file.is_file():
-        try:
-            with open(version_file, "r") as file:
-                cache_ver = file.read()
-                if cache_ver != __version__:
-                    print(f"115: cache {cache_ver} mismatch, want {__version__}, cleaning ...")
-                    clear_cache = True
-        except:
-            # something's wrong in cache structure, try clean it up
-            clear_cache = True
-    else:
-        clear_cache = True
+    global CACHE_APP, __version__
 
     cache_root = app_folder.joinpath(CACHE_ROOT)
-    cache_dir = app_folder / CACHE_PATH
+    # shared by all app folders, so runtime is downloaded once per machine
+    cache_dir = caching.machine_cache()
     build_dir = app_folder / CACHE_APP
 
     def make_cache_dirs():
@@ -141,27 +120,18 @@ def cache_check(app_folder, devmode=False):
 
         cache_root.mkdir(exist_ok=True)
         build_dir.mkdir(exist_ok=True)
-        cache_dir.mkdir(exist_ok=True)
-
-    if clear_cache:
-        win32 = sys.platform == "win32"
-        if shutil.rmtree.avoids_symlink_attacks or win32:
-            if cache_dir.is_dir():
-                if win32:
-                    warnings.warn("clear cache : rmtree is not safe on that system (win32)")
-                shutil.rmtree(cache_dir.as_posix())
-        else:
-            print(
-                "115: cannot clear cache : rmtree is not safe on that system",
-                file=sys.stderr,
-            )
-            raise SystemExit(115)
+        cache_dir.mkdir(parents=True, exist_ok=True)
 
-        # rebuild
-        make_cache_dirs()
+    make_cache_dirs()
 
-        with open(version_file, "w") as file:
-            file.write(__version__)
+    # cached files are kept but revalidated against CDN on first use
+    index = caching.Index(cache_dir)
+    if devmode:
+        # always revalidate in devmode, because cache source is local and changes a lot
+        print("103: DEVMODE: revalidating", DEFAULT_CDN)
+        index.invalidate(DEFAULT_CDN)
+    elif index.upgrade(__version__):
+        print(f"115: cache made by another pygbag version, want {__version__}, revalidating ...")
 
     return build_dir, cache_dir
 
@@ -219,6 +189,23 @@ async def main_run(app_folder, mainscript, cdn=DEFAULT_CDN):
 
     parser.add_argument("--cache", default=cache_dir.as_posix(), help="md5 based url cache directory")
 
+    parser.add_argument(
+        "--cache_size",
+        default=2048,
+        type=int,
+        help="url cache size limit in MiB, least recently used files are evicted, 0 for no limit [default:2048]",
+    )
+
+    parser.add_argument(
+        "--prefetch",
+        action="store_true",
+        help="download runtime, package indexes and packages imported by app for --PYBUILD from --cdn into cache, then exit",
+    )
+
+    parser.add_argument("--offline", action="store_true", help="never use network, serve only what is in cache")
+
+    parser.add_argument("--access_log", default="", help="log test server requests with timings to that file, - for stdout")
+
     parser.add_argument(
         "--package",
         default=f"web.pygame.{app_folder.name}-{int(datetime.timestamp(datetime.now()))}",
@@ -243,8 +230,33 @@ async def main_run(app_folder, mainscript, cdn=DEFAULT_CDN):
 
     parser.add_argument("--no_opt", action="store_true", help="turn off assets optimizer")
 
+    parser.add_argument("--pyc", action="store_true", help="also ship app modules as bytecode for --PYBUILD, main.py stays source")
+
+    parser.add_argument("--no_src", action="store_true", help="with --pyc, ship precompiled modules without their sources")
+
+    parser.add_argument(
+        "--minify",
+        action="store_true",
+        help="strip comments and docstrings from app modules, line numbers are kept",
+    )
+
+    parser.add_argument("--no_assert", action="store_true", help="with --minify, also strip assert statements")
+
     parser.add_argument("--archive", action="store_true", help="make build/web.zip archive for itch.io")
 
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="write per stage timings and sizes to build/profile.json and build/profile.txt",
+    )
+
+    parser.add_argument(
+        "--jobs",
+        default=0,
+        type=int,
+        help="number of parallel workers for asset conversion and packing, 0 is cpu count [default:0]",
+    )
+
     #    parser.add_argument(
     #        "--main",
     #        default=DEFAULT_SCRIPT,
@@ -269,6 +281,12 @@ async def main_run(app_folder, mainscript, cdn=DEFAULT_CDN):
 
     parser.add_argument("--ssl", default=False, help="enable ssl with server.pem and key.pem")
 
+    parser.add_argument(
+        "--aio",
+        action="store_true",
+        help="use the asyncio test server, one process for many concurrent clients",
+    )
+
     parser.add_argument(
         "--port",
         action="store",
@@ -282,10 +300,7 @@ async def main_run(app_folder, mainscript, cdn=DEFAULT_CDN):
 
     app_name = app_folder.name.lower().replace(" ", ".")
 
-    archfile = build_dir.joinpath(f"{app_name}.apk")
-
-    if archfile.is_file():
-        archfile.unlink()
+    # previous {app_name}.apk is kept, pack.archive reuses its unchanged members
 
     print(
         f"""
@@ -335,7 +350,24 @@ now packing application ....
 
     pygbag.config = CC
 
-    await pack.archive(f"{app_name}.apk", app_folder, build_dir)
+    caching.OFFLINE = args.offline
+
+    if args.prefetch:
+        if not prefetching.run(app_folder, args.cache, args.cdn, args.PYBUILD, args.template, args.icon, args.jobs, args.cache_size * 1024 * 1024):
+            sys.exit(1)
+        return
+
+    pybuild = args.PYBUILD if (args.pyc or args.no_src) else ""
+    await pack.archive(
+        f"{app_name}.apk",
+        app_folder,
+        build_dir,
+        jobs=args.jobs,
+        pybuild=pybuild,
+        sources=not args.no_src,
+        minify=args.minify or args.no_assert,
+        asserts=args.no_assert,
+    )
 
     def cache_file(remote_url, suffix):
         nonlocal cache_dir
@@ -346,6 +378,7 @@ now packing application ....
     # get local or online template in order
     # _______________________________________
 
+    prof = profiling.start("template")
     template_file = Path(args.template)
 
     if template_file.is_file():
@@ -358,6 +391,10 @@ now packing application ....
     else:
         tmpl_url = f"{args.cdn}{args.template}"
         tmpl = cache_file(tmpl_url, "tmpl")
+        if not tmpl.is_file() and caching.cached(args.cache, tmpl_url):
+            # from --prefetch or test server
+            tmpl = caching.cached(args.cache, tmpl_url)
+
         if tmpl.is_file():
             print(
                 f"""
@@ -377,20 +414,32 @@ now packing application ....
             )
 
             try:
+                if args.offline:
+                    raise Exception(f"offline and {tmpl_url} is not in cache, use --prefetch first")
                 template_file, headers = web.get(tmpl_url, tmpl)
             except Exception as e:
                 print(e)
                 print(f"CDN {args.cdn} is not responding : not running test server")
                 args.build = True
 
+    if template_file.is_file():
+        prof.add(template_file.stat())
+    profiling.stop(prof)
+
     if app_folder.joinpath("static").is_dir():
         print(
             f"""
         copying static files to webroot {build_dir}
 """
         )
-        # dirs_exist_ok = 3.8
-        shutil.copytree(app_folder.joinpath("static"), build_dir, dirs_exist_ok=True)
+        with profiling.stage("static") as prof:
+
+            def copy_static(src, dst):
+                prof.add(size=os.path.getsize(src))
+                return shutil.copy2(src, dst)
+
+            # dirs_exist_ok = 3.8
+            shutil.copytree(app_folder.joinpath("static"), build_dir, dirs_exist_ok=True, copy_function=copy_static)
 
     # get local or online favicon in order
     # _______________________________________
@@ -398,6 +447,8 @@ now packing application ....
     if not icon_file.is_file():
         icon_url = f"{args.cdn}{args.icon}"
         icon_file = cache_file(icon_url, "png")
+        if not icon_file.is_file() and caching.cached(args.cache, icon_url):
+            icon_file = caching.cached(args.cache, icon_url)
 
         if icon_file.is_file():
             print(
@@ -406,6 +457,9 @@ now packing application ....
     cached at {icon_file}"""
             )
 
+        elif args.offline:
+            print(f"offline and {icon_url} is not in cache, use --prefetch first")
+
         else:
             try:
                 icon_file, headers = web.get(icon_url, icon_file)
@@ -425,17 +479,29 @@ now packing application ....
         print(f"error: cannot find {icon_file=}")
 
     if template_file.is_file():
-        with template_file.open("r", encoding="utf-8") as source:
-            with open(build_dir.joinpath("index.html").resolve(), "w", encoding="utf-8") as target:
-                # while ( line := source.readline()):
-                while True:
-                    line = source.readline()
-                    if not line:
-                        break
-                    for k, v in CC.items():
-                        line = line.replace("{{cookiecutter." + k + "}}", str(v))
-
-                    target.write(line)
+        with profiling.stage("index.html") as prof:
+            prof.add(template_file.stat())
+            index_html = build_dir.joinpath("index.html").resolve()
+            with template_file.open("r", encoding="utf-8") as source:
+                with open(index_html, "w", encoding="utf-8") as target:
+                    # while ( line := source.readline()):
+                    while True:
+                        line = source.readline()
+                        if not line:
+                            break
+                        for k, v in CC.items():
+                            line = line.replace("{{cookiecutter." + k + "}}", str(v))
+
+                        target.write(line)
+            prof.add(index_html.stat(), out=True)
+
+        # served by testserver when browser accepts gzip/br, kept out of build_dir
+        if not (args.build or args.archive):
+            with profiling.stage("compress") as prof:
+                compressing.precompress_tree(build_dir, build_dir.with_name("web-variants"), prof)
+
+        if args.profile:
+            profiling.write(build_dir.parent)
 
         # files should be all ready and tested now
         # except on CDN error on first test, but you did test didn't you ?
@@ -455,7 +521,10 @@ now packing application ....
         elif not args.build:
             from . import testserver
 
-            testserver.run_code_server(args, CC)
+            if args.aio:
+                await testserver.run_async_code_server(args, CC)
+            else:
+                testserver.run_code_server(args, CC)
 
         else:
             print(
@@ -467,6 +536,8 @@ build_dir = {build_dir}
 """
             )
     else:
+        if args.profile:
+            profiling.write(build_dir.parent)
         print(args.template, "is not a valid template")
 
 
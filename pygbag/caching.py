@@ -0,0 +1,382 @@
+import os
+import sys
+import time
+import sqlite3
+import hashlib
+import threading
+import urllib.request
+from pathlib import Path
+
+from . import compressing
+from . import hashing
+
+# downloads in progress, by url
+FILLS = {}
+LOCK = threading.Lock()
+
+CHUNK = 64 * 1024
+
+# header added to .head files, content hash of .data computed while downloading
+DIGEST_HEADER = "x-pygbag-sha256"
+
+# Index of the web-cache folder in use, set by testserver
+INDEX = None
+
+# serve from cache only, set by --offline
+OFFLINE = False
+
+# last access is written at most that often per url (seconds)
+TOUCH_DELAY = 60
+
+# eviction goes down to that ratio of max size
+EVICT_RATIO = 0.9
+
+SCHEMA = """
+create table if not exists entries (
+    url text primary key,
+    key text not null,
+    size integer not null,
+    fetched real not null,
+    accessed real not null,
+    checked real not null,
+    etag text,
+    modified text,
+    sha256 text
+);
+create table if not exists meta (name text primary key, value real);
+"""
+
+
+def machine_cache():
+    # one web-cache per user and machine, shared by all app folders
+    if os.environ.get("PYGBAG_CACHE"):
+        return Path(os.environ["PYGBAG_CACHE"])
+    if sys.platform == "win32" and os.environ.get("LOCALAPPDATA"):
+        return Path(os.environ["LOCALAPPDATA"]) / "pygbag" / "web-cache"
+    base = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(base) / "pygbag" / "web-cache"
+
+
+def cache_key(url):
+    return hashlib.md5(url.encode()).hexdigest()
+
+
+def cached(folder, url):
+    # data file of a complete cache entry, or None
+    key = cache_key(url)
+    if Path(folder, f"{key}.head").is_file():
+        return Path(folder, f"{key}.data")
+    return None
+
+
+class Index:
+    # sqlite index of a web-cache folder : url, sizes, times and upstream validators.
+    # sqlite does the locking so several pygbag processes can share the folder.
+
+    def __init__(self, folder, max_size=0):
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.touched = {}
+        self.db = sqlite3.connect(self.folder / "index.sqlite", timeout=30, check_same_thread=False, isolation_level=None)
+        with self.lock:
+            self.db.execute("pragma journal_mode=wal")
+            self.db.executescript(SCHEMA)
+
+    def query(self, sql, *argv):
+        with self.lock:
+            return self.db.execute(sql, argv).fetchall()
+
+    def epoch(self):
+        # entries checked before that time must be revalidated
+        rows = self.query("select value from meta where name='epoch'")
+        return rows[0][0] if rows else 0.0
+
+    def invalidate(self, prefix=""):
+        # instead of clearing : keep data, revalidate on next use
+        if prefix:
+            # only urls under prefix, other users of the cache are not affected
+            # before any epoch, even when none was ever set
+            self.query("update entries set checked=-1 where substr(url, 1, ?)=?", len(prefix), prefix)
+            return
+
+        epoch = time.time()
+        self.query("insert or replace into meta values ('epoch', ?)", epoch)
+
+        # files not in index ( older cache layout, cached templates ) can't be revalidated.
+        # downloads of other processes are not indexed yet : skip temp files and recent ones.
+        keys = set(row[0] for row in self.query("select key from entries"))
+        for path in self.folder.iterdir():
+            if path.name.startswith("index.sqlite") or ".tmp" in path.name:
+                continue
+            try:
+                if not path.is_file() or path.stat().st_mtime >= epoch:
+                    continue
+                if path.name.split(".", 1)[0] not in keys:
+                    path.unlink()
+            except OSError:
+                pass
+
+    def upgrade(self, version):
+        # entries made by another pygbag version are revalidated once, returns True then.
+        # compared by sqlite : the real column stores a numeric looking version as a number.
+        if self.query("select 1 from meta where name='version' and value=?", version):
+            return False
+        self.invalidate()
+        self.query("insert or replace into meta values ('version', ?)", version)
+        return True
+
+    def stale(self, url):
+        rows = self.query("select checked from entries where url=?", url)
+        return not rows or rows[0][0] < self.epoch()
+
+    def digest(self, url):
+        rows = self.query("select sha256 from entries where url=?", url)
+        return rows[0][0] if rows else None
+
+    def validators(self, url):
+        # request headers for a conditional GET upstream
+        headers = {}
+        for etag, modified in self.query("select etag, modified from entries where url=?", url):
+            if etag:
+                headers["If-None-Match"] = etag
+            if modified:
+                headers["If-Modified-Since"] = modified
+        return headers
+
+    def record(self, url, size, headers, digest):
+        now = time.time()
+        self.query(
+            "insert or replace into entries values (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            url,
+            cache_key(url),
+            size,
+            now,
+            now,
+            now,
+            headers.get("etag"),
+            headers.get("last-modified"),
+            digest,
+        )
+        self.evict()
+
+    def resize(self, url):
+        # data plus precompressed variants
+        size = sum(path.stat().st_size for path in self.folder.glob(f"{cache_key(url)}.*"))
+        self.query("update entries set size=? where url=?", size, url)
+        self.evict()
+
+    def checked(self, url):
+        now = time.time()
+        self.query("update entries set checked=?, accessed=? where url=?", now, now, url)
+
+    def touch(self, url):
+        now = time.time()
+        if now - self.touched.get(url, 0) < TOUCH_DELAY:
+            return
+        self.touched[url] = now
+        self.query("update entries set accessed=? where url=?", now, url)
+
+    def evict(self):
+        if not self.max_size:
+            return
+        total = self.query("select coalesce(sum(size), 0) from entries")[0][0]
+        if total <= self.max_size:
+            return
+        for url, key, size in self.query("select url, key, size from entries order by accessed"):
+            if total <= self.max_size * EVICT_RATIO:
+                break
+            # head first, so entry is seen as missing before data goes away
+            head = self.folder / f"{key}.head"
+            if head.is_file():
+                head.unlink()
+            for path in self.folder.glob(f"{key}.*"):
+                try:
+                    path.unlink()
+                except OSError:
+                    pass
+            self.query("delete from entries where url=?", url)
+            total -= size
+            print("EVICTED:", url)
+
+
+# content hashes of served files, by (path, mtime, size)
+ETAGS = {}
+ETAGS_MAX = 4096
+
+
+class Fill:
+    # one download to cache, shared by all requests for the same url
+
+    def __init__(self, url, data, head, validators=None):
+        self.url = url
+        self.validators = validators or {}
+        self.data = data
+        self.head = head
+        self.tmp = data.with_name(f"{data.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        self.cond = threading.Condition()
+        self.headers = None
+        self.length = None
+        self.size = 0
+        self.done = False
+        self.error = None
+
+    def run(self):
+        try:
+            digest = hashlib.sha256()
+            request = urllib.request.Request(self.url, headers=self.validators)
+            try:
+                response = urllib.request.urlopen(request)
+            except urllib.error.HTTPError as e:
+                if e.code != 304:
+                    raise
+                # still the same upstream, keep cached copy
+                if INDEX:
+                    INDEX.checked(self.url)
+                return
+
+            with response, open(self.tmp, "wb") as out:
+                length = response.headers.get("content-length")
+                with self.cond:
+                    self.headers = str(response.headers)
+                    self.length = int(length) if length and length.isdigit() else None
+                    self.cond.notify_all()
+
+                while chunk := response.read(CHUNK):
+                    digest.update(chunk)
+                    out.write(chunk)
+                    # followers read the file, not the buffer
+                    out.flush()
+                    with self.cond:
+                        self.size += len(chunk)
+                        self.cond.notify_all()
+
+            if self.length is not None and self.size != self.length:
+                raise OSError(f"truncated download {self.size}/{self.length}")
+
+            os.replace(self.tmp, self.data)
+            # head is written last, its presence marks a complete entry
+            head_tmp = self.head.with_name(f"{self.tmp.name}.head")
+            head_tmp.write_text(self.headers.rstrip("\n") + f"\n{DIGEST_HEADER}: {digest.hexdigest()}\n\n")
+            os.replace(head_tmp, self.head)
+            if INDEX:
+                INDEX.record(self.url, self.size, response.headers, digest.hexdigest())
+
+        except Exception as e:
+            self.error = e
+            try:
+                os.unlink(self.tmp)
+            except OSError:
+                pass
+        finally:
+            with LOCK:
+                FILLS.pop(self.url, None)
+            with self.cond:
+                self.done = True
+                self.cond.notify_all()
+
+        if self.error is None and compressing.compressible(urllib.parse.urlsplit(self.url).path):
+            try:
+                compressing.precompress(self.data)
+                if INDEX:
+                    INDEX.resize(self.url)
+            except OSError as e:
+                print("ERROR: precompressing", self.url, e)
+
+    def wait(self, streaming=False):
+        # until headers are known when streaming, else until complete
+        with self.cond:
+            while not self.done and not (streaming and self.headers is not None):
+                self.cond.wait()
+
+
+class Follower:
+    # file like reader of a download in progress, read() waits for data
+
+    def __init__(self, fill):
+        self.fill = fill
+        self.length = fill.length
+        self.headers = fill.headers
+        self.pos = 0
+        self.file = open(fill.tmp, "rb")
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def read(self, size=-1):
+        fill = self.fill
+        with fill.cond:
+            while self.pos >= fill.size and not fill.done:
+                fill.cond.wait()
+            if fill.error:
+                raise OSError(f"download of {fill.url} failed : {fill.error}")
+            available = fill.size - self.pos
+        if size is None or size < 0 or size > available:
+            size = available
+        data = self.file.read(size)
+        self.pos += len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+def etag(path, st, digest=None):
+    # strong validator, content hash is computed once per file version
+    key = (str(path), st.st_mtime_ns, st.st_size)
+    value = ETAGS.get(key)
+    if value is None:
+        value = digest or hashing.file_digest(path)
+        if len(ETAGS) >= ETAGS_MAX:
+            ETAGS.clear()
+        ETAGS[key] = value
+    return f'"{value}"'
+
+
+def matches(header, tag):
+    # If-None-Match, weak comparison as rfc 9110 asks for GET
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate == "*":
+            return True
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == tag:
+            return True
+    return False
+
+
+def fetch(url, data, head, streaming=False):
+    """
+    fill cache entry data/head from url, only one download per url whatever the number of requests.
+    returns a Follower when streaming was asked and upstream gave a length, None otherwise : then
+    the entry is complete, or head file is missing on error.
+    """
+    with LOCK:
+        fill = FILLS.get(url)
+        if fill is None:
+            if OFFLINE:
+                # never blocks on network, stale entries are served as is
+                return None
+            validators = None
+            if head.is_file():
+                if not (INDEX and INDEX.stale(url)):
+                    return None
+                # revalidate, 304 keeps current entry, 200 replaces it
+                validators = INDEX.validators(url)
+            fill = Fill(url, data, head, validators)
+            FILLS[url] = fill
+            threading.Thread(target=fill.run, name="pygbag-fill", daemon=True).start()
+
+    fill.wait(streaming)
+    with fill.cond:
+        if streaming and not fill.done and fill.length is not None:
+            try:
+                return Follower(fill)
+            except OSError:
+                # tmp file just got renamed
+                pass
+
+    fill.wait()
+    return None
@@ -0,0 +1,73 @@
+import sys
+import py_compile
+from pathlib import Path
+
+from . import hashing
+from .gathering import Asset
+
+# version of pyc-cache entries, see hashing.entry()
+CACHE_VERSION = 1
+
+# run from source by pythonrc, never precompiled
+SKIP = ["/main.py"]
+
+
+def cache_tag(pybuild):
+    # sys.implementation.cache_tag of the browser interpreter
+    return f"cpython-{pybuild.replace('.', '')}"
+
+
+def usable(pybuild):
+    # bytecode is only valid for the exact minor version that made it
+    return f"{sys.version_info.major}.{sys.version_info.minor}" == pybuild
+
+
+def compiled_name(name, pybuild, sources):
+    # where the import system looks for it : __pycache__ next to source, or sourceless in place of it
+    path = Path(name)
+    if sources:
+        return (path.parent / "__pycache__" / f"{path.stem}.{cache_tag(pybuild)}.pyc").as_posix()
+    return path.with_suffix(".pyc").as_posix()
+
+
+def compile_one(asset, pybuild, sources, cache):
+    pyc = hashing.entry(cache, ".pyc", CACHE_VERSION, hashing.file_digest(asset.path), pybuild, sources, asset.name)
+    if not pyc.is_file():
+        # checked hash : still right if source is edited in the browser. Sourceless has nothing to check.
+        if sources:
+            mode = py_compile.PycInvalidationMode.CHECKED_HASH
+        else:
+            mode = py_compile.PycInvalidationMode.UNCHECKED_HASH
+        py_compile.compile(str(asset.path), cfile=str(pyc), dfile=asset.name[1:], doraise=True, invalidation_mode=mode)
+    return Asset(compiled_name(asset.name, pybuild, sources), pyc, pyc.stat())
+
+
+def precompile(packlist, pybuild, sources, cache):
+    # adds .pyc for app modules to packlist, replaces the .py when sources are not wanted
+    if not usable(pybuild):
+        print(f"WARNING: cannot precompile for python {pybuild} with python {sys.version_info.major}.{sys.version_info.minor}, shipping sources")
+        return list(packlist)
+
+    cache = Path(cache)
+    cache.mkdir(parents=True, exist_ok=True)
+
+    result = []
+    count = 0
+    for asset in packlist:
+        if not asset.name.endswith(".py") or asset.name in SKIP:
+            result.append(asset)
+            continue
+        try:
+            pyc = compile_one(asset, pybuild, sources, cache)
+        except py_compile.PyCompileError as e:
+            # let the browser report it at import time
+            print("ERROR: precompiling", asset.name, e.msg)
+            result.append(asset)
+            continue
+        if sources:
+            result.append(asset)
+        result.append(pyc)
+        count += 1
+
+    print(f"precompiled {count} modules for python {pybuild}")
+    return result
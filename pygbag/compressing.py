@@ -0,0 +1,153 @@
+import os
+import gzip
+from pathlib import Path
+
+try:
+    import brotli
+except:
+    brotli = None
+
+# only worth it for text and wasm, images/audio/apk are already compressed
+COMPRESSIBLE = [".js", ".mjs", ".wasm", ".py", ".html", ".htm", ".json", ".css", ".txt", ".data", ".svg", ".map", ".tmpl"]
+
+# testserver rewrites those before sending, they are compressed on the fly
+REWRITTEN = [".html", ".htm"]
+
+# content-coding : file suffix, in order of preference
+SUFFIXES = {"br": ".br", "gzip": ".gz"}
+
+# variant is dropped when it does not save at least that
+MIN_RATIO = 0.9
+
+# served folder : folder holding its variants, so deploy output only has what the user built
+MIRRORS = {}
+
+
+def encodings():
+    if brotli:
+        return ["br", "gzip"]
+    return ["gzip"]
+
+
+def compressible(name):
+    return Path(str(name)).suffix.lower() in COMPRESSIBLE
+
+
+def compress(data, encoding):
+    if encoding == "br":
+        return brotli.compress(data)
+    # mtime=0 : same input gives same bytes
+    return gzip.compress(data, compresslevel=6, mtime=0)
+
+
+class BrotliWriter:
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.compressor = brotli.Compressor()
+
+    def write(self, data):
+        self.fileobj.write(self.compressor.process(data))
+
+    def close(self):
+        self.fileobj.write(self.compressor.finish())
+
+
+def writer(fileobj, encoding):
+    # streaming version of compress(), close() does not close fileobj
+    if encoding == "br":
+        return BrotliWriter(fileobj)
+    return gzip.GzipFile(fileobj=fileobj, mode="wb", compresslevel=6, mtime=0)
+
+
+def variant(path, encoding):
+    path = Path(path)
+    if MIRRORS:
+        resolved = path.resolve()
+        for root, mirror in MIRRORS.items():
+            if root in resolved.parents:
+                path = mirror / resolved.relative_to(root)
+                break
+    return path.with_name(path.name + SUFFIXES[encoding])
+
+
+def precompress(path):
+    # write path.gz ( and path.br ) if missing or older than path, returns variants written
+    path = Path(path)
+    st = path.stat()
+    data = None
+    written = []
+    for encoding in encodings():
+        target = variant(path, encoding)
+        try:
+            if target.stat().st_mtime_ns >= st.st_mtime_ns:
+                continue
+        except FileNotFoundError:
+            pass
+
+        if data is None:
+            data = path.read_bytes()
+        packed = compress(data, encoding)
+        if len(packed) > len(data) * MIN_RATIO:
+            # not worth a round of decoding in the browser
+            if target.is_file():
+                target.unlink()
+            continue
+
+        target.parent.mkdir(parents=True, exist_ok=True)
+        tmp = target.with_name(f"{target.name}.{os.getpid()}.tmp")
+        tmp.write_bytes(packed)
+        os.replace(tmp, target)
+        written.append(target)
+    return written
+
+
+def precompress_tree(folder, mirror, prof=None):
+    # variants of files in folder go to the same place under mirror
+    MIRRORS[Path(folder).resolve()] = Path(mirror).resolve()
+    for current, dirnames, filenames in os.walk(folder):
+        for filename in filenames:
+            if not compressible(filename) or Path(filename).suffix.lower() in REWRITTEN:
+                continue
+            path = Path(current, filename)
+            written = precompress(path)
+            if prof:
+                prof.add(path.stat())
+                for target in written:
+                    prof.add(target.stat(), out=True)
+
+
+def accepted(header):
+    # content-codings from an Accept-Encoding header, by decreasing preference
+    if not header:
+        return []
+    qualities = {}
+    for item in header.split(","):
+        coding, _, params = item.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        qualities[coding.strip().lower()] = q
+
+    result = []
+    for encoding in encodings():
+        q = qualities.get(encoding, qualities.get("*", 0.0))
+        if q > 0:
+            result.append((q, encoding))
+    result.sort(key=lambda item: -item[0])
+    return [encoding for q, encoding in result]
+
+
+def negotiate(path, header, st):
+    # best fresh precompressed variant of path for that Accept-Encoding, or None
+    for encoding in accepted(header):
+        target = variant(path, encoding)
+        try:
+            if target.stat().st_mtime_ns >= st.st_mtime_ns:
+                return encoding, target
+        except FileNotFoundError:
+            pass
+    return None
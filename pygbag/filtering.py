@@ -1,41 +1,131 @@
+import re
 from pathlib import Path
 
 dbg = True
 
+# folders never walked, relative to app folder
+BLOCK_FOLDERS = ["/.git", "/.github", "/build", "/venv", "/.venv", "/node_modules", "/ignore", "/.idea"]
 
-def filter(walked):
-    global dbg
-    for folder, filenames in walked:
-        blocking = False
+BLOCK_FILES = [".gitignore", "pygbag.ignore"]
 
-        for block in ["/.git", "/.github", "/build", "/venv", "/ignore", "/.idea"]:
-            if folder.match(block):
-                if dbg:
-                    print("REJ 1", folder)
-                blocking = True
-                break
+BLOCK_EXT = ["pyc", "pyx", "pyd", "pyi", "exe", "log", "DS_Store"]
 
-            fx = folder.as_posix()
+# user rules, same syntax as .gitignore
+IGNORE_FILES = [".gitignore", "pygbag.ignore"]
 
-            if fx.startswith(f"{block}/"):
-                if dbg:
-                    print("REJ 2", folder)
-                blocking = True
-                break
 
-        if blocking:
+def translate(pattern):
+    # one .gitignore line to a regex matching a posix path relative to app folder
+    anchored = "/" in pattern.rstrip("/")
+    pattern = pattern.strip("/")
+
+    rx = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith("**/", i):
+            rx.append("(?:.*/)?")
+            i += 3
+            continue
+        if pattern.startswith("/**", i) and i + 3 == len(pattern):
+            rx.append("/.*")
+            i += 3
+            continue
+        if pattern.startswith("**", i):
+            rx.append(".*")
+            i += 2
             continue
+        if c == "*":
+            rx.append("[^/]*")
+        elif c == "?":
+            rx.append("[^/]")
+        elif c == "[":
+            end = pattern.find("]", i + 1)
+            if end < 0:
+                rx.append(re.escape(c))
+            else:
+                body = pattern[i + 1 : end]
+                if body.startswith("!"):
+                    body = "^" + body[1:]
+                rx.append(f"[{body}]")
+                i = end
+        elif c == "\\" and i + 1 < len(pattern):
+            i += 1
+            rx.append(re.escape(pattern[i]))
+        else:
+            rx.append(re.escape(c))
+        i += 1
 
-        for filename in filenames:
-            if filename in [".gitignore"]:
-                if dbg:
-                    print("REJ 3", folder, filename)
-                continue
+    if anchored:
+        return "".join(rx)
+    return "(?:.*/)?" + "".join(rx)
+
+
+def compiled(patterns):
+    if not patterns:
+        # matches nothing
+        return re.compile(r"(?!)")
+    return re.compile("|".join(f"(?:{rx})" for rx in patterns))
+
+
+class Rules:
+    # all folder and file rules folded into a few regex, built once per build.
+
+    def __init__(self, root=None):
+        folders = [translate(block) for block in BLOCK_FOLDERS]
+        files = [f"(?:.*/)?{re.escape(name)}" for name in BLOCK_FILES]
+        files.append("(?:.*/)?[^/]*\\.(?i:" + "|".join(map(re.escape, BLOCK_EXT)) + ")")
+        keep = []
+
+        if root is not None:
+            for ignore_file in IGNORE_FILES:
+                ignore_file = Path(root) / ignore_file
+                if not ignore_file.is_file():
+                    continue
+                for line in ignore_file.read_text(encoding="utf-8", errors="replace").splitlines():
+                    line = line.rstrip()
+                    if not line or line.startswith("#"):
+                        continue
+                    if line.startswith("!"):
+                        keep.append(translate(line[1:]))
+                        continue
+                    rx = translate(line)
+                    folders.append(rx)
+                    # trailing / only applies to folders
+                    if not line.endswith("/"):
+                        files.append(rx)
+
+        # anything below a blocked folder is blocked too
+        self.folders = compiled([f"{rx}(?:/.*)?" for rx in folders])
+        self.files = compiled(files)
+        self.keep = compiled(keep)
+
+    def skip_folder(self, rel):
+        # rel is posix, relative to app folder with a leading /
+        rel = rel.strip("/")
+        return bool(rel and self.folders.fullmatch(rel) and not self.keep.fullmatch(rel))
+
+    def skip_file(self, rel):
+        rel = rel.strip("/")
+        if rel == "main.py":
+            return False
+        return bool(self.files.fullmatch(rel) and not self.keep.fullmatch(rel))
+
+
+def filter(walked, rules=None):
+    global dbg
+    rules = rules or Rules()
+    for folder, assets in walked:
+        # gather() already pruned blocked folders, this is for other walkers
+        if rules.skip_folder(folder.as_posix()):
+            if dbg:
+                print("REJ 1", folder)
+            continue
 
-            ext = filename.rsplit(".", 1)[-1].lower()
-            if ext in ["pyc", "pyx", "pyd", "pyi", "exe", "log", "DS_Store"]:
+        for asset in assets:
+            if rules.skip_file(asset.name):
                 if dbg:
-                    print("REJ 4", folder, filename)
+                    print("REJ 3", asset.name)
                 continue
 
-            yield Path(folder), Path(folder).joinpath(filename)
+            yield Path(folder), asset
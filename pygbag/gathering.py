@@ -1,4 +1,5 @@
-from os import walk
+import os
+from collections import namedtuple
 from pathlib import Path
 
 
@@ -6,13 +7,47 @@ class Error(Exception):
     pass
 
 
-def gather(root: Path, *kw):
+# name : posix path as seen by the app, relative to app folder with a leading /
+# path : file holding the data, may live outside the app folder ( eg optimizer cache )
+# stat : os.stat_result of path taken once while gathering, downstream stages reuse it
+Asset = namedtuple("Asset", "name path stat", defaults=(None,))
+
+
+def scan(root, current, rel, rules):
+    # same order as os.walk topdown, but keeps each DirEntry stat result
+    files = []
+    folders = []
+    try:
+        with os.scandir(current) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir():
+                        # like os.walk(followlinks=False)
+                        if not entry.is_symlink():
+                            folders.append(entry)
+                    elif entry.is_file():
+                        name = f"{rel}{entry.name}"
+                        files.append(Asset(name, Path(entry.path), entry.stat()))
+                except OSError:
+                    continue
+    except OSError:
+        # unreadable folder, os.walk would skip it too
+        return
+
+    yield Path(rel), files
+
+    for entry in folders:
+        sub = f"{rel}{entry.name}/"
+        if rules and rules.skip_folder(sub):
+            # blocked trees ( venv, node_modules ... ) are never walked
+            continue
+        yield from scan(root, entry.path, sub, rules)
+
+
+def gather(root: Path, *kw, rules=None):
     if root.is_file():
         if root.name == "main.py":
             raise Error("project must be a folder or an archive")
 
-    for current, dirnames, filenames in walk(root):
-        rel = Path("/").joinpath(Path(current).relative_to(root))
-
-        # print(rel, len(dirnames), len(filenames))
-        yield rel, filenames
+    # yields folder relative to root and the Asset list of its files
+    yield from scan(root, str(root), "/", rules)
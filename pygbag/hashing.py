@@ -0,0 +1,41 @@
+import os
+import hashlib
+from pathlib import Path
+
+# assets can be large, hash them by chunks
+CHUNK = 64 * 1024
+
+
+def file_digest(path):
+    # sha256 of file content, hex
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        while chunk := file.read(CHUNK):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def entry(cache, suffix, version, *key):
+    """
+    path of a content addressed cache entry : its name is the hash of the cache version and
+    of everything the result depends on, so an entry never goes stale. Bumping version drops
+    all entries of that cache at once.
+    """
+    text = ":".join(str(part) for part in (version, *key))
+    return Path(cache) / f"{hashlib.sha256(text.encode()).hexdigest()}{suffix}"
+
+
+def partial(target):
+    # where target is built, keeps its suffix for tools that guess the format from it
+    return target.with_suffix(f".tmp{target.suffix}")
+
+
+def publish(tmp, target):
+    # never leave a partial file under the final name
+    os.replace(tmp, target)
+
+
+def store(target, data):
+    tmp = partial(target)
+    tmp.write_bytes(data)
+    publish(tmp, target)
@@ -1,44 +1,189 @@
+import zlib
+import base64
+import hashlib
 from pathlib import Path
 
 import pygbag
 
+from . import compressing
+
 
 def stringify(blob):
-    c = 0
-    for b in blob:
-        yield chr(int(b) + 248)
-        c += 1
-        if c > 78:
-            yield "\n"
-            c = 0
+    # base64 alphabet can neither end the ''' string nor the <script> tag.
+    # returns (zlib flag, text), compressed only when worth a decompress at startup.
+    packed = zlib.compress(blob, 9)
+    if len(packed) < len(blob) * compressing.MIN_RATIO:
+        return 1, base64.encodebytes(packed).decode("ascii")
+    return 0, base64.encodebytes(blob).decode("ascii")
 
 
-def dump_fs(html, target_folder, packlist):
-    html.write(
-        f"""PYGBAG_FS={len(packlist)}
-# fmt: off
+# embedded virtual filesystem : fs_decode() only indexes the blobs, a file is decoded
+# to disk the first time something opens, stats or scans it.
+VFS = """# fmt: off
 __import__('os').chdir(__import__('tempfile').gettempdir())
-def fs_decode(fsname, o248):
-    from pathlib import Path
-    filename = Path.cwd() / fsname
-    if not filename.is_file():
-        filename.parent.mkdir(parents=True, exist_ok=True)
-        with open(fsname,"wb") as fs:
-            for input in o248.split("\\n"):
-                if not input: continue
-                fs.write(bytes([ord(c) - 248 for c in input]))
+def fs_mount():
+    import sys, os, io, builtins, binascii, zlib
+    vfs = type(sys)("pygbag_vfs")
+    vfs.root = os.getcwd()
+    vfs.index = {}
+    # C loaders do not use open() : wrap them, or decode what they may need on import
+    vfs.wrap = {"pygame.image": ("load",), "pygame.mixer_music": ("load", "queue")}
+    vfs.eager = {"pygame.mixer": (".ogg", ".wav", ".mp3"), "pygame.font": (".ttf", ".otf"), "pygame.freetype": (".ttf", ".otf")}
+    real = {"open": io.open, "stat": os.stat, "listdir": os.listdir, "scandir": os.scandir}
+
+    def relative(path):
+        if not isinstance(path, (str, bytes, os.PathLike)):
+            return None
+        path = os.path.abspath(os.fsdecode(path))
+        if path == vfs.root:
+            return ""
+        if path.startswith(vfs.root + "/"):
+            return path[len(vfs.root) + 1 :]
+        return None
+
+    def extract(name):
+        blob = vfs.index.pop(name, None)
+        if blob is None:
+            return
+        b64, z = blob
+        data = binascii.a2b_base64(b64)
+        if z:
+            data = zlib.decompress(data)
+        target = os.path.join(vfs.root, name)
+        with real["open"](target + ".tmp", "wb") as file:
+            file.write(data)
+        os.replace(target + ".tmp", target)
+
+    def access(path):
+        if vfs.index:
+            name = relative(path)
+            if name:
+                extract(name)
+
+    def pending(path):
+        # names still in index directly under folder path
+        folder = relative(path) if vfs.index else None
+        if folder is None:
+            return []
+        return [name for name in vfs.index if name.rpartition("/")[0] == folder]
+
+    def open(file, *argv, **kw):
+        access(file)
+        return real["open"](file, *argv, **kw)
+
+    def stat(path, *argv, **kw):
+        access(path)
+        return real["stat"](path, *argv, **kw)
+
+    def listdir(path=None):
+        names = real["listdir"](path)
+        for name in pending("." if path is None else path):
+            base = name.rpartition("/")[2]
+            base = os.fsencode(base) if isinstance(path, bytes) else base
+            if base not in names:
+                names.append(base)
+        return names
+
+    def scandir(path=None):
+        for name in pending("." if path is None else path):
+            extract(name)
+        return real["scandir"](path)
+
+    def wrap(call):
+        def wrapper(file, *argv, **kw):
+            access(file)
+            return call(file, *argv, **kw)
+        wrapper.__name__ = call.__name__
+        wrapper.__doc__ = call.__doc__
+        return wrapper
+
+    def patch(module):
+        for attr in vfs.wrap.get(module.__name__, ()):
+            if hasattr(module, attr):
+                setattr(module, attr, wrap(getattr(module, attr)))
+        suffixes = vfs.eager.get(module.__name__)
+        if suffixes:
+            for name in [name for name in vfs.index if name.lower().endswith(suffixes)]:
+                extract(name)
+
+    class Loader:
+        def __init__(self, loader):
+            self.loader = loader
+        def __getattr__(self, attr):
+            return getattr(self.loader, attr)
+        def create_module(self, spec):
+            return self.loader.create_module(spec)
+        def exec_module(self, module):
+            self.loader.exec_module(module)
+            patch(module)
+
+    class Finder:
+        @classmethod
+        def find_spec(cls, fullname, path=None, target=None):
+            if fullname not in vfs.wrap and fullname not in vfs.eager:
+                return None
+            for finder in sys.meta_path:
+                if finder is cls or not hasattr(finder, "find_spec"):
+                    continue
+                spec = finder.find_spec(fullname, path, target)
+                if spec is not None and spec.loader is not None:
+                    spec.loader = Loader(spec.loader)
+                    return spec
+            return None
+
+    def start():
+        builtins.open = io.open = open
+        os.stat, os.listdir, os.scandir = stat, listdir, scandir
+        sys.meta_path.insert(0, Finder)
+        for name in set(vfs.wrap) | set(vfs.eager):
+            if name in sys.modules:
+                patch(sys.modules[name])
+
+    def extract_all():
+        for name in list(vfs.index):
+            extract(name)
+
+    vfs.start = start
+    vfs.extract = access
+    vfs.extract_all = extract_all
+    sys.modules[vfs.__name__] = vfs
+    return vfs
+PYGBAG_VFS = fs_mount()
+def fs_decode(fsname, b64, z=0):
+    import os
+    if not os.path.isfile(fsname):
+        os.makedirs(os.path.dirname(fsname) or ".", exist_ok=True)
+        PYGBAG_VFS.index[fsname] = (b64, z)
+def fs_alias(fsname, source):
+    # same content as source, shares its blob. Like fs_decode, a file already there is kept.
+    import os
+    if os.path.isfile(fsname):
+        print(f"fs_alias: {fsname} exists, not replaced by a copy of {source}")
+        return
+    os.makedirs(os.path.dirname(fsname) or ".", exist_ok=True)
+    if source in PYGBAG_VFS.index:
+        PYGBAG_VFS.index[fsname] = PYGBAG_VFS.index[source]
+    elif os.path.isfile(source):
+        # source was kept from disk, it has no blob to share
+        __import__('shutil').copyfile(source, fsname)
+    else:
+        print(f"fs_alias: {fsname} source {source} is missing")
 """
-    )
 
-    for topack in packlist:
+
+def dump_fs(html, target_folder, packlist):
+    html.write(f"PYGBAG_FS={len(packlist)}\n")
+    html.write(VFS)
+
+    # vfs name of first file by content hash
+    blobs = {}
+    for topack, src_name, st in packlist:
         if topack == "/main.py":
             continue
 
-        vfs_name = topack[1:].replace("-pygbag.", ".")
+        vfs_name = topack[1:]
 
-        src_name = target_folder / topack[1:]
-
-        sum = str(src_name.stat().st_size)
+        sum = str((st or src_name.stat()).st_size)
 
         if topack.lower().endswith(".py"):
             html.write(
@@ -50,12 +195,16 @@ with open("{vfs_name}","w") as fs:fs.write("""\\
             html.write("\n")
 
         else:
-            html.write(f"\nfs_decode('{vfs_name}','''\n")
-            for text in stringify(open(src_name, "rb").read()):
-                html.write(text)
-            html.write("''')\n")
+            blob = open(src_name, "rb").read()
+            digest = hashlib.sha256(blob).hexdigest()
+            if digest in blobs:
+                html.write(f"fs_alias('{vfs_name}','{blobs[digest]}')\n")
+                continue
+            blobs[digest] = vfs_name
+            z, text = stringify(blob)
+            html.write(f"\nfs_decode('{vfs_name}','''\n{text}''',{z})\n")
 
-    html.write("\n# fmt:on\ndel fs_decode, PYGBAG_FS\n")
+    html.write("\n# fmt:on\nPYGBAG_VFS.start()\ndel fs_mount, fs_alias, PYGBAG_VFS\ndel fs_decode, PYGBAG_FS\n")
 
 
 def make_header(html, line):
@@ -91,7 +240,7 @@ def html_embed(target_folder, packlist: list, htmlfile: str):
     MAX = 0
 
     for packed_file in packlist:
-        print("HTML:", packed_file)
+        print("HTML:", packed_file.name)
 
     topack = "/main.py"
 
@@ -109,8 +258,9 @@ def html_embed(target_folder, packlist: list, htmlfile: str):
 
         for lnum, line in main_py():
             if SKIP:
-                if line.endswith("del fs_decode, PYGBAG_FS"):
+                if line.rstrip().endswith("del fs_decode, PYGBAG_FS"):
                     SKIP = False
+                    continue
             if line.startswith("PYGBAG_FS="):
                 SKIP = True
 
@@ -0,0 +1,146 @@
+import io
+import ast
+import tokenize
+from pathlib import Path
+
+from . import hashing
+from .gathering import Asset
+
+# version of min-cache entries, see hashing.entry()
+CACHE_VERSION = 2
+
+# run from source by pythonrc, which looks for markers in its comments
+SKIP = ["/main.py"]
+
+# tokens that can span lines, their inner line breaks are part of the code
+MULTILINE = set(getattr(tokenize, name) for name in ("STRING", "FSTRING_MIDDLE") if hasattr(tokenize, name))
+
+
+def docstrings(tree):
+    # docstrings, and strings used as comments : any other would become the docstring once the first is gone
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Expr) and isinstance(node.value, ast.Constant) and isinstance(node.value.value, str):
+            yield node
+
+
+def bodies(tree):
+    for node in ast.walk(tree):
+        for field in ("body", "orelse", "finalbody"):
+            body = getattr(node, field, None)
+            if isinstance(body, list) and body and isinstance(body[0], ast.stmt):
+                yield body
+
+
+def minify(source, asserts=False):
+    """
+    strip comments, docstrings and optionally asserts from python source, returns minified source.
+    emptied lines are kept blank so line numbers in tracebacks match the app source.
+    raises SyntaxError when source does not parse, and also for valid source when a stripped
+    statement shares its line with another one ( eg "if x:\\n    assert x; y = 2" ).
+    """
+    source = source.replace("\r\n", "\n")
+    lines = source.split("\n")
+    tree = ast.parse(source)
+
+    def column(row, offset):
+        # ast offsets are utf-8 bytes, tokenize ones are characters
+        return len(lines[row - 1].encode("utf-8")[:offset].decode("utf-8", "replace"))
+
+    # statements to drop
+    removed = {id(node) for node in docstrings(tree)}
+    if asserts:
+        removed.update(id(node) for node in ast.walk(tree) if isinstance(node, ast.Assert))
+
+    # spans to delete per row : [start, end) in characters
+    cuts = {}
+    inserts = {}
+
+    def cut(srow, scol, erow, ecol):
+        for row in range(srow, erow + 1):
+            start = scol if row == srow else 0
+            end = ecol if row == erow else len(lines[row - 1])
+            cuts.setdefault(row, []).append((start, end))
+
+    for body in bodies(tree):
+        dropped = [node for node in body if id(node) in removed]
+        if not dropped:
+            continue
+        for node in dropped:
+            cut(node.lineno, column(node.lineno, node.col_offset), node.end_lineno, column(node.end_lineno, node.end_col_offset))
+        if len(dropped) == len(body):
+            # a block can't be empty
+            first = body[0]
+            inserts[first.lineno] = (column(first.lineno, first.col_offset), "pass")
+
+    # rows whose line break is inside a string that stays
+    keep = set()
+    for token in tokenize.generate_tokens(io.StringIO(source).readline):
+        srow, scol = token.start
+        erow, ecol = token.end
+        if token.type == tokenize.COMMENT:
+            # shebang and encoding declaration
+            if srow <= 2 and (token.string.startswith("#!") or "coding" in token.string):
+                continue
+            cut(srow, scol, erow, ecol)
+        elif token.type in MULTILINE and erow > srow:
+            if any(start <= scol < end for start, end in cuts.get(srow, ())):
+                continue
+            keep.update(range(srow, erow))
+
+    result = []
+    for row, line in enumerate(lines, 1):
+        spans = sorted(cuts.get(row, ()))
+        if spans or row in inserts:
+            parts = []
+            pos = 0
+            for start, end in spans:
+                if start > pos:
+                    parts.append(line[pos:start])
+                pos = max(pos, end)
+            parts.append(line[pos:])
+            line = "".join(parts)
+            if row in inserts:
+                col, text = inserts[row]
+                line = f"{line[:col]}{text}{line[col:]}"
+
+        if row not in keep:
+            line = line.rstrip()
+        result.append(line)
+
+    text = "\n".join(result)
+    # some spans can't be cut on their own, caller then leaves that file as is
+    ast.parse(text)
+    return text
+
+
+def minify_all(packlist, cache, asserts=False):
+    # replaces .py assets by their minified version
+    cache = Path(cache)
+    cache.mkdir(parents=True, exist_ok=True)
+
+    result = []
+    count = 0
+    saved = 0
+    for asset in packlist:
+        if not asset.name.endswith(".py") or asset.name in SKIP:
+            result.append(asset)
+            continue
+
+        data = Path(asset.path).read_bytes()
+        target = hashing.entry(cache, ".py", CACHE_VERSION, hashing.file_digest(asset.path), asserts)
+        if not target.is_file():
+            try:
+                text = minify(data.decode("utf-8"), asserts)
+            except (SyntaxError, ValueError, UnicodeDecodeError, tokenize.TokenError) as e:
+                print("minify-skip", asset.name, e)
+                result.append(asset)
+                continue
+            hashing.store(target, text.encode("utf-8"))
+
+        st = target.stat()
+        result.append(Asset(asset.name, target, st))
+        count += 1
+        saved += len(data) - st.st_size
+
+    print(f"minified {count} modules, {saved} bytes saved")
+    return result
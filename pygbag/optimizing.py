@@ -1,7 +1,17 @@
 import os
 import sys
+import shutil
+import subprocess
+import time
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 
+from . import hashing
+from .gathering import Asset
+
 
 """
 pngquant -f --ext -pygbag.png --quality 40 $(find|grep png$)
@@ -25,96 +35,220 @@ https://github.com/scour-project/scour
 
 
 """
+# version of opt-cache entries, see hashing.entry()
+CACHE_VERSION = 1
+
+# seconds spent per stage by last optimize() run, and files yielded.
+# convert is summed over workers, so it can exceed the wall time of the run.
+STATS = {}
+
+# conversions add up their own time from worker threads
+STATS_LOCK = threading.Lock()
+
+
+def renamed(item):
+    # leftovers of older pygbag versions or hand made "-pygbag" files replace their source
+    return item._replace(name=item.name.replace("-pygbag.", "."))
+
+
+def timed(stage, iterable):
+    # account time spent producing each item, not time spent by the consumer
+    iterator = iter(iterable)
+    while True:
+        t0 = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            STATS[stage] += time.perf_counter() - t0
+            return
+        STATS[stage] += time.perf_counter() - t0
+        yield item
+
+
+def unique(assets):
+    # ordered set : first asset to claim a name wins, membership test is O(1)
+    seen = set()
+    for item in assets:
+        t0 = time.perf_counter()
+        fresh = item.name not in seen
+        if fresh:
+            seen.add(item.name)
+        STATS["dedupe"] += time.perf_counter() - t0
+        if fresh:
+            STATS["files"] += 1
+            yield item
+
+
+def report():
+    print(f"optimizer: {STATS['files']} files, scan {STATS['scan']:.3f}s, convert {STATS['convert']:.3f}s, dedupe {STATS['dedupe']:.3f}s")
+
+
+def reset():
+    STATS.update(scan=0.0, convert=0.0, dedupe=0.0, files=0)
+
+
+reset()
+
 if sys.platform != "linux":
 
     def optimize(folder, filenames, **kw):
-        yield from filenames
+        reset()
+        yield from unique(renamed(item) for item in timed("scan", filenames))
+        report()
 
 else:
 
-    def optimize(folder, filenames, **kw):
+    @lru_cache(maxsize=None)
+    def version(tool, *argv):
+        # once per process, not once per build. Empty when tool is unusable.
+        if not shutil.which(tool):
+            return ""
+        try:
+            out = subprocess.run([tool, *argv], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL)
+        except OSError:
+            return ""
+        if out.returncode:
+            return ""
+        return out.stdout.decode("utf-8", "replace").strip().split("\n")[0]
+
+    def cached(cache, src, tool, tool_version, settings, suffix):
+        return hashing.entry(cache, suffix, CACHE_VERSION, hashing.file_digest(src), tool, tool_version, settings)
+
+    def convert(cmd, opt):
+        # runs in a worker thread, the heavy lifting is done by the tool subprocess
+        tmp = hashing.partial(opt)
+        t0 = time.perf_counter()
+        out = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL)
+        with STATS_LOCK:
+            STATS["convert"] += time.perf_counter() - t0
+        if out.returncode or not tmp.is_file():
+            print("ERROR", " ".join(map(str, cmd)), "for", opt)
+            print(out.stdout.decode("utf-8", "replace"))
+            if tmp.is_file():
+                tmp.unlink()
+            return False
+        hashing.publish(tmp, opt)
+        return True
+
+    def optimize(folder, filenames, jobs=0, cache=None, **kw):
+        reset()
+        yield from unique(converted(folder, filenames, jobs, cache))
+        report()
+
+    def converted(folder, filenames, jobs, cache):
         print("optimizing", folder)
         png_quality = 50
 
-        done_list = []
+        # converted files are kept out of the app folder
+        cache = Path(cache or Path(folder) / "build" / "opt-cache")
 
-        if os.popen("pngquant 2>&1").read().count("pngfile"):
+        png_version = version("pngquant", "--version")
+        if png_version:
             print(f"    -> with pngquant --quality {png_quality}", folder)
         else:
             png_quality = -1
 
-        has_ffmpeg = os.popen("ffmpeg -version").read().count("version")
-
-        truncate = len(str(folder))
-
-        def translated(fn):
-            nonlocal truncate
-            return str(fn)[truncate:]
+        ffmpeg_version = version("ffmpeg", "-version")
+        has_ffmpeg = bool(ffmpeg_version)
 
         # turn off all opt
         if "--no_opt" in sys.argv:
-            for fp in filenames:
+            for item in timed("scan", filenames):
+                fp = Path(item.name)
                 if fp.stem.endswith("-pygbag"):
                     continue
 
                 if fp.suffix == ".mp3":
                     continue
 
-                if fp not in done_list:
-                    done_list.append(fp)
-                    yield fp.as_posix()
+                yield item
             return
 
-        for fp in filenames:
-            if fp.suffix == ".png":
-                if png_quality >= 0:
-                    if not fp.stem.endswith("-pygbag"):
-                        # .with_stem() 3.9+
-                        opt = Path(f"{folder}/{fp.parent}/{fp.stem}-pygbag.png")
-
-                        if opt.is_file():
-                            # this is the no opt source, skip it
-                            print("opt-skip(38)", fp)
+        cache.mkdir(parents=True, exist_ok=True)
+
+        jobs = jobs or os.cpu_count() or 1
+
+        # files were listed once by gather, no need to ask the filesystem again
+        filenames = list(filenames)
+        names = set(item.name for item in filenames)
+
+        def plan():
+            for item in filenames:
+                fp = Path(item.name)
+                src = item.path
+                if fp.suffix == ".png":
+                    if png_quality >= 0:
+                        if not fp.stem.endswith("-pygbag"):
+                            # .with_stem() 3.9+
+                            if fp.with_name(f"{fp.stem}-pygbag.png").as_posix() in names:
+                                # a -pygbag file already stands for that source, skip it
+                                print("opt-skip(38)", fp)
+                                continue
+
+                            opt = cached(cache, src, "pngquant", png_version, f"--quality {png_quality}", ".png")
+                            if opt.is_file():
+                                yield item, opt, None
+                            else:
+                                yield item, opt, ["pngquant", "-f", "--quality", str(png_quality), "--output", str(hashing.partial(opt)), str(src)]
                             continue
 
-                        osexec = f'pngquant -f --ext -pygbag.png --quality {png_quality} "{folder}{fp}"'
-                        os.system(osexec)
-                        if opt.is_file():
-                            yield translated(opt)
+                elif fp.suffix in [".mp3", ".wav", ".ogg", ".flac"]:
+                    if not fp.stem.endswith("-pygbag"):
+                        if fp.with_name(f"{fp.stem}-pygbag.ogg").as_posix() in names:
+                            # a -pygbag file already stands for that source, skip it
+                            print("opt-skip(73)", fp)
                             continue
-                        else:
-                            print("ERROR", osexec, "for", opt)
-
-            elif fp.suffix in [".mp3", ".wav", ".ogg", ".flac"]:
-                if not fp.stem.endswith("-pygbag"):
-                    opt = Path(f"{folder}/{fp.parent}/{fp.stem}-pygbag.ogg")
-                    if opt.is_file():
-                        # this is the no opt source, skip it
-                        print("opt-skip(73)", fp)
-                        continue
-
-                    osexec = f'ffmpeg -i "{folder}{fp}" -ac 1 -r 22000 "{opt}"'
-
-                    if has_ffmpeg:
-                        os.system(osexec)
-
-                    if opt.is_file():
-                        yield translated(opt)
-                        continue
-                    else:
+
                         if has_ffmpeg:
-                            print("ERROR", osexec, "for", opt)
+                            opt = cached(cache, src, "ffmpeg", ffmpeg_version, "-ac 1 -r 22000", ".ogg")
+                            if opt.is_file():
+                                yield item, opt, None
+                            else:
+                                yield item, opt, ["ffmpeg", "-nostdin", "-y", "-i", str(src), "-ac", "1", "-r", "22000", str(hashing.partial(opt))]
+                            continue
+
+                yield item, None, None
 
-                        if fp.suffix == ".mp3":
-                            print(
-                                f"""
+        def finish(item, opt, state):
+            # state is a Future for a running conversion, True for a cache hit, None when left as is
+            if isinstance(state, Future):
+                state = state.result()
+
+            fp = Path(item.name)
+            if state:
+                return Asset(fp.with_suffix(opt.suffix).as_posix(), opt, opt.stat())
+
+            if fp.suffix == ".mp3":
+                print(
+                    f"""
 
        ERROR: MP3 audio format is not allowed on web, convert {fp} to ogg
 
 """
-                            )
-                            sys.exit(3)
-
-            if fp not in done_list:
-                done_list.append(fp)
-                yield fp.as_posix()
+                )
+                sys.exit(3)
+
+            return renamed(item)
+
+        # identical sources share a cache entry, convert them only once
+        running = {}
+
+        # bounded pipeline : at most jobs * 2 files in flight, results released in input order
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            pending = deque()
+            for item, opt, cmd in timed("scan", plan()):
+                if cmd:
+                    if opt not in running:
+                        running[opt] = pool.submit(convert, cmd, opt)
+                    pending.append((item, opt, running[opt]))
+                else:
+                    pending.append((item, opt, opt is not None or None))
+
+                while pending:
+                    state = pending[0][2]
+                    if isinstance(state, Future) and not state.done() and len(pending) < jobs * 2:
+                        break
+                    yield finish(*pending.popleft())
+
+            while pending:
+                yield finish(*pending.popleft())
@@ -1,117 +1,463 @@
 import sys, os
+import stat
 import zipfile
+import zlib
+import struct
+import json
+import hashlib
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 from .gathering import gather
-from .filtering import filter
+from .filtering import filter, Rules
 from .optimizing import optimize
+from . import optimizing
+from . import compiling
+from . import minifying
+from . import hashing
 from .html_embed import html_embed
+from . import profiling
+from .watching import Watcher
 
 COUNTER = 0
 
+# bump when the manifest layout changes, old manifests are then ignored
+MANIFEST_VERSION = 1
+
+# same settings as zipfile.ZipFile(compression=ZIP_DEFLATED, compresslevel=9)
+COMPRESSLEVEL = 9
+CHUNK = 1024 * 8
+
+# below that amount of data to deflate, a worker pool costs more than it saves
+PARALLEL_MIN = 4 * 1024 * 1024
+
+# identical files are stored once, other names go in that member, restored by pythonrc at startup
+ALIASES = ".pygbag-aliases.json"
+
+# below that size a member costs about the same as its alias entry
+ALIAS_MIN = 512
+
 
 class REPLAY:
     HTML = False
     LIST = []
     APK = ""
     TARGET = ""
+    MANIFEST = ""
+    JOBS = 0
+    RULES = None
+    OPT_CACHE = None
+    # (PYBUILD, keep sources, cache folder) when precompiling
+    PYC = None
+    # (cache folder, strip asserts) when minifying
+    MINIFY = None
+    WATCHER = None
+    # the test server may replay from several request threads at once
+    LOCK = threading.Lock()
+
+
+def manifest_load(manifest):
+    try:
+        with open(manifest, "r") as file:
+            data = json.load(file)
+        if data.get("version") == MANIFEST_VERSION:
+            return data["members"]
+    except (OSError, ValueError, KeyError):
+        pass
+    return {}
+
+
+def manifest_save(manifest, members):
+    with open(manifest, "w") as file:
+        json.dump({"version": MANIFEST_VERSION, "members": members}, file, indent=1)
+
+
+def deflate(filename):
+    # one pass over the file for content hash, crc and the raw deflate stream
+    # the stream is byte-identical to what zipfile.ZipFile.write would produce.
+    sha = hashlib.sha256()
+    crc = 0
+    size = 0
+    compressor = zlib.compressobj(COMPRESSLEVEL, zlib.DEFLATED, -15)
+    payload = []
+    with open(filename, "rb") as file:
+        while True:
+            data = file.read(CHUNK)
+            if not data:
+                break
+            sha.update(data)
+            crc = zlib.crc32(data, crc)
+            size += len(data)
+            payload.append(compressor.compress(data))
+    payload.append(compressor.flush())
+    return sha.hexdigest(), crc, size, b"".join(payload)
+
+
+def deflate_all(filenames, jobs=0):
+    # results come back in submission order so the archive layout does not depend on jobs count.
+    # threads and not processes : zlib and hashlib release the GIL, and the test server
+    # replays from a threaded process that must not fork.
+    jobs = jobs or os.cpu_count() or 1
+    if jobs < 2 or len(filenames) < 2:
+        for filename in filenames:
+            yield deflate(filename)
+        return
+
+    with ThreadPoolExecutor(max_workers=min(jobs, len(filenames))) as pool:
+        window = deque()
+        for filename in filenames:
+            window.append(pool.submit(deflate, filename))
+            # bound memory held by out of order results
+            if len(window) >= jobs * 2:
+                yield window.popleft().result()
+        while window:
+            yield window.popleft().result()
 
 
-async def pack_files(zf, packlist, zfolders, target_folder):
+def read_raw(zf, zip_name, crc):
+    # fetch the still compressed stream of a member from a previous archive
+    try:
+        zinfo = zf.getinfo(zip_name)
+    except KeyError:
+        return None
+
+    if zinfo.CRC != crc or zinfo.compress_type != zipfile.ZIP_DEFLATED:
+        return None
+
+    zf.fp.seek(zinfo.header_offset)
+    fheader = struct.unpack(zipfile.structFileHeader, zf.fp.read(zipfile.sizeFileHeader))
+    # skip filename and extra field of the local header
+    zf.fp.seek(fheader[10] + fheader[11], os.SEEK_CUR)
+    payload = zf.fp.read(zinfo.compress_size)
+    if len(payload) != zinfo.compress_size:
+        return None
+    return payload
+
+
+def raw_writable(zf):
+    # read_raw() and write_raw() rely on zipfile internals, without them members go through zf.write()
+    internals = ("fp", "start_dir", "filelist", "NameToInfo", "_writecheck", "_didModify")
+    return all(hasattr(zf, name) for name in internals) and all(hasattr(zipfile.ZipInfo, name) for name in ("FileHeader", "_compresslevel"))
+
+
+def write_raw(zf, zinfo, payload):
+    # append an already deflated member, mimics zipfile.ZipFile.write on a seekable file.
+    zip64 = zinfo.file_size * 1.05 > zipfile.ZIP64_LIMIT
+    zinfo.compress_size = len(payload)
+    zinfo.flag_bits = 0x00
+    zf.fp.seek(zf.start_dir)
+    zinfo.header_offset = zf.fp.tell()
+    zf._writecheck(zinfo)
+    zf._didModify = True
+    zf.fp.write(zinfo.FileHeader(zip64))
+    zf.fp.write(payload)
+    zf.filelist.append(zinfo)
+    zf.NameToInfo[zinfo.filename] = zinfo
+    zf.start_dir = zf.fp.tell()
+
+
+def zipinfo(zip_name, st):
+    # zipfile.ZipInfo.from_file without another stat call
+    zinfo = zipfile.ZipInfo(zip_name, time.localtime(st.st_mtime)[0:6])
+    zinfo.external_attr = (st.st_mode & 0xFFFF) << 16
+    zinfo.file_size = st.st_size
+    return zinfo
+
+
+def pack_files(zf, packlist, zfolders, target_folder, previous=None, old=None, jobs=0):
     global COUNTER
 
-    for asset in packlist:
-        zpath = list(zfolders)
-        zpath.insert(0, str(target_folder))
-        zpath.append(str(asset)[1:])
+    previous = previous or {}
+    members = {}
+    reused = 0
+    raw = raw_writable(zf)
+    if not raw:
+        old = None
 
-        # print(f"\t{str(asset)[1:]}")
-        zip_content = target_folder / str(asset)[1:]
+    planned = []
+    todo = []
+    todo_size = 0
+
+    for asset in packlist:
+        zip_content = asset.path
 
         zpath = list(zfolders)
-        zpath.append(str(asset)[1:].replace("-pygbag.", "."))
+        zpath.append(asset.name[1:])
 
-        if not zip_content.is_file():
+        st = asset.stat
+        if st is None:
+            try:
+                st = os.stat(zip_content)
+            except OSError:
+                st = None
+
+        if st is None or not stat.S_ISREG(st.st_mode):
             print("32: ERROR", zip_content)
             break
-        zip_name = Path("/".join(zpath))
+        zip_name = "/".join(zpath)
         # TODO: TEST SHEBANG for .html -> .py extension
         COUNTER += 1
-        zf.write(zip_content, zip_name)
+
+        zinfo = zipinfo(zip_name, st)
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        if raw:
+            zinfo._compresslevel = COMPRESSLEVEL
+
+        entry = {
+            "path": asset.name,
+            "size": zinfo.file_size,
+            "mtime": st.st_mtime_ns,
+        }
+
+        payload = None
+        known = previous.get(zip_name)
+        if old and known and known["size"] == entry["size"]:
+            if known["mtime"] == entry["mtime"]:
+                entry["sha256"] = known["sha256"]
+            else:
+                # touched but maybe not modified
+                entry["sha256"] = hashing.file_digest(zip_content)
+
+            if entry["sha256"] == known["sha256"]:
+                # an alias was stored under the name of its first copy
+                payload = read_raw(old, known.get("alias", zip_name), known["crc"])
+                if payload is not None:
+                    entry["crc"] = known["crc"]
+                    reused += 1
+
+        if payload is None:
+            todo.append(zip_content)
+            todo_size += zinfo.file_size
+
+        planned.append([zinfo, entry, payload, zip_content])
+
+    if todo_size < PARALLEL_MIN:
+        jobs = 1
+    deflated = deflate_all(todo, jobs)
+
+    stored = {}
+    aliases = {}
+    for zinfo, entry, payload, zip_content in planned:
+        if payload is None:
+            entry["sha256"], entry["crc"], zinfo.file_size, payload = next(deflated)
+
+        first = stored.get(entry["sha256"])
+        if first and zinfo.file_size >= ALIAS_MIN:
+            entry["alias"] = first.filename
+            aliases[entry["path"][1:]] = members[first.filename]["path"][1:]
+            members[zinfo.filename] = entry
+            continue
+
+        zinfo.CRC = entry["crc"]
+        if raw:
+            write_raw(zf, zinfo, payload)
+        else:
+            zf.write(zip_content, zinfo.filename)
+        members[zinfo.filename] = entry
+        stored.setdefault(entry["sha256"], zinfo)
+
+    # release worker threads
+    deflated.close()
+
+    if aliases:
+        zinfo = zipfile.ZipInfo("/".join([*zfolders, ALIASES]))
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        zf.writestr(zinfo, json.dumps(aliases, indent=1, sort_keys=True))
+        print(f"stored {len(aliases)} duplicate members once")
+
+    if reused:
+        print(f"reused {reused} unchanged members from previous archive")
+    return members
+
+
+def pack_apk(apkname, packlist, target_folder, manifest=None, jobs=0):
+    # build into a temporary file so the previous archive can feed unchanged members.
+    apkname = str(apkname)
+    building = f"{apkname}.tmp"
+    if os.path.isfile(building):
+        os.unlink(building)
+
+    previous = {}
+    old = None
+    if manifest and os.path.isfile(apkname):
+        previous = manifest_load(manifest)
+        if previous:
+            try:
+                old = zipfile.ZipFile(apkname, "r")
+            except (OSError, zipfile.BadZipFile):
+                previous = {}
+
+    try:
+        with zipfile.ZipFile(building, mode="x", compression=zipfile.ZIP_DEFLATED, compresslevel=COMPRESSLEVEL) as zf:
+            members = pack_files(zf, packlist, ["assets"], target_folder, previous, old, jobs)
+    finally:
+        if old:
+            old.close()
+
+    os.replace(building, apkname)
+    if manifest:
+        manifest_save(manifest, members)
+
+
+def collect(target_folder, rules, jobs=0, opt_cache=None):
+    # gather + filter + optimize, quiet version of what archive() does
+    walked = gather(target_folder, rules=rules)
+    filtered = [asset for infolder, asset in filter(walked, rules)]
+    packlist = list(optimize(target_folder, filtered, jobs=jobs, cache=opt_cache))
+    if REPLAY.MINIFY:
+        packlist = minifying.minify_all(packlist, *REPLAY.MINIFY)
+    if REPLAY.PYC:
+        packlist = compiling.precompile(packlist, *REPLAY.PYC)
+    return packlist
+
+
+def replayable(changed):
+    # edits of files already packed as is only need a repack, anything else needs a new packlist
+    asis = set(asset.name for asset in REPLAY.LIST if Path(asset.path) == REPLAY.TARGET.joinpath(asset.name[1:]))
+    for name in changed:
+        if name not in asis or not REPLAY.TARGET.joinpath(name[1:]).is_file():
+            return False
+        # its bytecode or minified version must be made again
+        if (REPLAY.PYC or REPLAY.MINIFY) and name.endswith(".py"):
+            return False
+    return True
+
+
+def watch():
+    # replay will then only repack when something changed on disk
+    if REPLAY.TARGET and not REPLAY.HTML and REPLAY.WATCHER is None:
+        REPLAY.WATCHER = Watcher(REPLAY.TARGET, REPLAY.RULES).start()
+        print(f"watching {REPLAY.TARGET} for changes with {REPLAY.WATCHER.mode}")
 
 
 def stream_pack_replay():
     global COUNTER, REPLAY
-    if os.path.isfile(REPLAY.APK):
-        os.unlink(REPLAY.APK)
-    zfolders = ["assets"]
-    with zipfile.ZipFile(REPLAY.APK, mode="x", compression=zipfile.ZIP_DEFLATED, compresslevel=9) as zf:
-        for asset in REPLAY.LIST:
-            zpath = list(zfolders)
-            zpath.insert(0, str(REPLAY.TARGET))
-            zpath.append(str(asset)[1:])
-
-            zip_content = REPLAY.TARGET / str(asset)[1:]
-            zpath = list(zfolders)
-            zpath.append(str(asset)[1:].replace("-pygbag.", "."))
-
-            if not zip_content.is_file():
-                print("32: ERROR", zip_content)
-                break
-            zip_name = Path("/".join(zpath))
-            zf.write(zip_content, zip_name)
+    with REPLAY.LOCK:
+        if REPLAY.WATCHER and os.path.isfile(REPLAY.APK):
+            changed = REPLAY.WATCHER.changes()
+            if changed is not None and not changed:
+                print(f"replay: no change, {REPLAY.APK} is up to date")
+                return
+
+            if changed is None or not replayable(changed):
+                print("replay: file list changed, collecting again")
+                REPLAY.LIST = collect(REPLAY.TARGET, REPLAY.RULES, REPLAY.JOBS, REPLAY.OPT_CACHE)
+            else:
+                print(f"replay: {len(changed)} file(s) changed")
 
+        # files may have been edited since the build, do not trust gathered stats
+        packlist = [asset._replace(stat=None) for asset in REPLAY.LIST]
+        pack_apk(REPLAY.APK, packlist, REPLAY.TARGET, REPLAY.MANIFEST, REPLAY.JOBS)
     print(f"replay packing {len(REPLAY.LIST)=} files complete for {REPLAY.APK}")
 
 
-async def archive(apkname, target_folder, build_dir=None):
+async def archive(apkname, target_folder, build_dir=None, jobs=0, pybuild="", sources=True, minify=False, asserts=False):
+    # with pybuild set, app modules also go as bytecode for that python, or only as bytecode without sources
+    # minify strips comments, docstrings and asserts if asked from modules before packing
     global COUNTER, REPLAY
 
     COUNTER = 0
 
     if build_dir:
         apkname = build_dir.joinpath(apkname).as_posix()
+        # keep build state out of the served folder
+        manifest = build_dir.parent.joinpath(f"{Path(apkname).name}.json").as_posix()
+    else:
+        manifest = f"{apkname}.json"
+
+    rules = Rules(target_folder)
 
     walked = []
-    for folder, filenames in gather(target_folder):
-        walked.append([folder, filenames])
-        sched_yield()
+    with profiling.stage("gather") as prof:
+        for folder, assets in gather(target_folder, rules=rules):
+            walked.append([folder, assets])
+            for asset in assets:
+                prof.add(asset.stat)
+            sched_yield()
 
     filtered = []
     last = ""
-    for infolder, fullpath in filter(walked):
-        if last != infolder:
-            print(f"Now in {infolder}")
-            last = infolder
+    with profiling.stage("filter") as prof:
+        for folder, assets in walked:
+            for asset in assets:
+                prof.add(asset.stat)
+        for infolder, asset in filter(walked, rules):
+            if last != infolder:
+                print(f"Now in {infolder}")
+                last = infolder
+
+            print(" " * 4, asset.name)
+            filtered.append(asset)
+            prof.add(asset.stat, out=True)
+            sched_yield()
 
-        print(" " * 4, fullpath)
-        filtered.append(fullpath)
-        sched_yield()
+    if build_dir:
+        opt_cache = build_dir.parent / "opt-cache"
+    else:
+        opt_cache = None
 
     packlist = []
-    for filename in optimize(target_folder, filtered):
-        packlist.append(filename)
-        sched_yield()
+    with profiling.stage("optimize") as prof:
+        for asset in filtered:
+            prof.add(asset.stat)
+        for asset in optimize(target_folder, filtered, jobs=jobs, cache=opt_cache):
+            packlist.append(asset)
+            prof.add(asset.stat, out=True)
+            sched_yield()
+        prof.details.update(optimizing.STATS)
+
+    if minify:
+        build = build_dir.parent if build_dir else Path(target_folder) / "build"
+        REPLAY.MINIFY = (build / "min-cache", asserts)
+
+        with profiling.stage("minify") as prof:
+            for asset in packlist:
+                prof.add(asset.stat)
+            packlist = minifying.minify_all(packlist, *REPLAY.MINIFY)
+            for asset in packlist:
+                prof.add(asset.stat, out=True)
 
     REPLAY.LIST = packlist
     REPLAY.APK = apkname
     REPLAY.TARGET = target_folder
+    REPLAY.MANIFEST = manifest
+    REPLAY.JOBS = jobs
+    REPLAY.RULES = rules
+    REPLAY.OPT_CACHE = opt_cache
 
     if "--html" in sys.argv:
+        # page is run from source
         REPLAY.HTML = True
-        html_embed(target_folder, packlist, f"{apkname[:-4]}.html")
+        with profiling.stage("html_embed") as prof:
+            for asset in packlist:
+                prof.add(asset.stat)
+            html_embed(target_folder, packlist, f"{apkname[:-4]}.html")
+            prof.add(os.stat(f"{apkname[:-4]}.html"), out=True)
         return
 
-    try:
-        with zipfile.ZipFile(apkname, mode="x", compression=zipfile.ZIP_DEFLATED, compresslevel=9) as zf:
-            # pack_files(zf, Path.cwd(), ["assets"], target_folder)
-            await pack_files(zf, packlist, ["assets"], target_folder)
-
-    except TypeError:
-        # 3.6 does not support compresslevel
-        with zipfile.ZipFile(apkname, mode="x", compression=zipfile.ZIP_DEFLATED) as zf:
-            # pack_files(zf, Path.cwd(), ["assets"], target_folder)
-            await pack_files(zf, packlist, ["assets"], target_folder)
+    if pybuild:
+        if build_dir:
+            pyc_cache = build_dir.parent / "pyc-cache"
+        else:
+            pyc_cache = Path(target_folder) / "build" / "pyc-cache"
+        REPLAY.PYC = (pybuild, sources, pyc_cache)
+
+        with profiling.stage("precompile") as prof:
+            for asset in packlist:
+                prof.add(asset.stat)
+            packlist = compiling.precompile(packlist, *REPLAY.PYC)
+            for asset in packlist:
+                prof.add(asset.stat, out=True)
+        REPLAY.LIST = packlist
+
+    with profiling.stage("pack") as prof:
+        for asset in packlist:
+            prof.add(asset.stat)
+        pack_apk(apkname, packlist, target_folder, manifest, jobs)
+        prof.add(os.stat(apkname), out=True)
 
     print(f"packing {COUNTER} files complete")
 
@@ -0,0 +1,157 @@
+import re
+import ast
+import json
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+from . import caching
+from . import hashing
+from .gathering import gather
+from .filtering import filter, Rules
+
+# always loaded by pythons.js from cdn
+RUNTIME = [
+    "pythons.js",
+    "pythonrc.py",
+    "browserfs.min.js",
+    "vt.js",
+    "vtx.js",
+    "empty.ogg",
+    "empty.html",
+    "xtermjsixel/xterm-addon-image-worker.js",
+]
+
+# loaded from {cdn}python{digits}/
+PYTHON = ["main.js", "main.wasm", "main.data"]
+
+# package indexes, relative to repo
+INDEXES = ["repodata.json", "index.json"]
+
+# what the template pulls from cdn
+RX_CDN = re.compile(r"\{\{cookiecutter\.cdn\}\}/?([^\"'\s<>{}]+)")
+
+
+def runtime_urls(cdn, pybuild, template=""):
+    names = list(RUNTIME)
+    names.extend(f"python{pybuild.replace('.', '')}/{name}" for name in PYTHON)
+    names.extend(RX_CDN.findall(template))
+    return list(dict.fromkeys(f"{cdn}{name}" for name in names))
+
+
+def imported(app_folder):
+    # top level modules imported by app code
+    rules = Rules(app_folder)
+    modules = set()
+    for folder, asset in filter(gather(app_folder, rules=rules), rules):
+        if not asset.name.endswith(".py"):
+            continue
+        try:
+            tree = ast.parse(Path(asset.path).read_bytes())
+        except (SyntaxError, ValueError, OSError):
+            continue
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                modules.update(alias.name.split(".")[0] for alias in node.names)
+            elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+                modules.add(node.module.split(".")[0])
+    return modules
+
+
+def package_urls(repo, repodata, modules):
+    # packages providing modules, with their dependencies : {url: sha256}
+    packages = repodata.get("packages", {})
+    providers = {}
+    for name, info in packages.items():
+        for module in info.get("imports", [name]):
+            providers.setdefault(module, name)
+
+    wanted = [providers[module] for module in sorted(modules) if module in providers]
+    urls = {}
+    seen = set()
+    while wanted:
+        name = wanted.pop()
+        if name in seen or name not in packages:
+            continue
+        seen.add(name)
+        info = packages[name]
+        if info.get("file_name"):
+            urls[f"{repo}{info['file_name']}"] = info.get("sha256")
+        wanted.extend(info.get("depends", []))
+    return urls
+
+
+def fetch_one(folder, url, expected=None):
+    # fill one entry and check its content hash, returns an error or None
+    key = caching.cache_key(url)
+    data = folder / f"{key}.data"
+    head = folder / f"{key}.head"
+    for attempt in range(2):
+        # digest of the copy already on disk, it only stays a reference if upstream did not replace it
+        before = caching.INDEX.digest(url) if head.is_file() else None
+        caching.fetch(url, data, head)
+        if not head.is_file():
+            return "download failed"
+        want = expected
+        if not want and before and caching.INDEX.digest(url) == before:
+            want = before
+        if not want:
+            # fresh download and no sha256 from repodata : nothing independent to check against
+            print(f"prefetch: {url} not verified, no known sha256")
+            return None
+        digest = hashing.file_digest(data)
+        if digest == want:
+            return None
+        # corrupted or changed upstream : start again from scratch
+        head.unlink()
+        data.unlink()
+    return f"sha256 mismatch, want {want} got {digest}"
+
+
+def prefetch(folder, urls, jobs=0):
+    # urls is {url: sha256 or None}, returns {url: error} for failures
+    folder = Path(folder)
+    with ThreadPoolExecutor(max_workers=jobs or 8) as pool:
+        results = pool.map(lambda url: (url, fetch_one(folder, url, urls[url])), urls)
+        return {url: error for url, error in results if error}
+
+
+def run(app_folder, folder, cdn, pybuild, template, icon, jobs=0, max_size=0):
+    folder = Path(folder)
+    caching.INDEX = caching.Index(folder, max_size)
+
+    # local template, or the one from cdn
+    failed = {}
+    total = 0
+    if Path(template).is_file():
+        text = Path(template).read_text(encoding="utf-8")
+    else:
+        total += 1
+        failed.update(prefetch(folder, {f"{cdn}{template}": None}, jobs))
+        data = caching.cached(folder, f"{cdn}{template}")
+        text = data.read_text(encoding="utf-8") if data else ""
+
+    urls = dict.fromkeys(runtime_urls(cdn, pybuild, text))
+    if not Path(icon).is_file():
+        urls[f"{cdn}{icon}"] = None
+
+    # packages come from the repo at cdn root, like testserver proxies them
+    repo = "/".join(cdn.split("/")[:3]) + "/archives/repo/"
+    indexes = dict.fromkeys(f"{repo}{name}" for name in INDEXES)
+    failed.update(prefetch(folder, indexes, jobs))
+
+    repodata = folder / f"{caching.cache_key(repo + INDEXES[0])}.data"
+    if repodata.is_file():
+        try:
+            found = package_urls(repo, json.loads(repodata.read_bytes()), imported(app_folder))
+            print(f"prefetch: {len(found)} package(s) for app imports")
+            urls.update(found)
+        except (ValueError, AttributeError) as e:
+            print("prefetch: cannot read package index", e)
+
+    print(f"prefetch: {len(urls)} files from {cdn} into {folder}")
+    failed.update(prefetch(folder, urls, jobs))
+    total += len(indexes) + len(urls)
+    for url, error in failed.items():
+        print(f"ERROR: {url} : {error}")
+    print(f"prefetch: {total - len(failed)} ok, {len(failed)} failed")
+    return not failed
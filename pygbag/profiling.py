@@ -0,0 +1,113 @@
+import os
+import sys
+import json
+import time
+import platform
+from contextlib import contextmanager
+from pathlib import Path
+
+from .__init__ import __version__
+
+# stages of current build, in execution order
+STAGES = []
+
+
+class Stage:
+    def __init__(self, name):
+        self.name = name
+        self.files_in = 0
+        self.files_out = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.details = {}
+
+    def add(self, st=None, size=0, out=False):
+        # account one file, from its stat result or a plain size
+        if st is not None:
+            size = st.st_size
+        if out:
+            self.files_out += 1
+            self.bytes_out += size
+        else:
+            self.files_in += 1
+            self.bytes_in += size
+
+    def as_dict(self):
+        return {
+            "name": self.name,
+            "wall": round(self.wall, 6),
+            "cpu": round(self.cpu, 6),
+            "files_in": self.files_in,
+            "files_out": self.files_out,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "details": self.details,
+        }
+
+
+def cpu_time():
+    # include reaped children : pack workers, pngquant, ffmpeg ...
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+def start(name):
+    record = Stage(name)
+    record.wall = time.perf_counter()
+    record.cpu = cpu_time()
+    return record
+
+
+def stop(record):
+    record.wall = time.perf_counter() - record.wall
+    record.cpu = cpu_time() - record.cpu
+    STAGES.append(record)
+
+
+@contextmanager
+def stage(name):
+    record = start(name)
+    try:
+        yield record
+    finally:
+        stop(record)
+
+
+def reset():
+    STAGES.clear()
+
+
+def summary():
+    lines = [f"pygbag {__version__} build profile, python {platform.python_version()} on {sys.platform}", ""]
+    lines.append(f"{'stage':<16}{'wall(s)':>10}{'cpu(s)':>10}{'files in':>10}{'out':>8}{'KiB in':>12}{'out':>12}")
+    wall = 0.0
+    for record in STAGES:
+        wall += record.wall
+        lines.append(
+            f"{record.name:<16}{record.wall:>10.3f}{record.cpu:>10.3f}{record.files_in:>10}{record.files_out:>8}{record.bytes_in // 1024:>12}{record.bytes_out // 1024:>12}"
+        )
+    lines.append(f"{'total':<16}{wall:>10.3f}")
+    return "\n".join(lines)
+
+
+def write(build_root):
+    build_root = Path(build_root)
+    report = {
+        "version": __version__,
+        "python": platform.python_version(),
+        "platform": sys.platform,
+        "time": int(time.time()),
+        "stages": [record.as_dict() for record in STAGES],
+    }
+    with open(build_root / "profile.json", "w") as file:
+        json.dump(report, file, indent=1)
+
+    text = summary()
+    with open(build_root / "profile.txt", "w") as file:
+        print(text, file=file)
+
+    print()
+    print(text)
+    print(f"\nprofile written to {build_root / 'profile.json'}\n")
@@ -656,6 +656,20 @@ ________________________
         else:
             shell.pgzrun()
 
+    @classmethod
+    def aliases(cls, folder):
+        # packer stored identical files only once, copy them back under their other names
+        manifest = Path(folder) / ".pygbag-aliases.json"
+        if not manifest.is_file():
+            return
+        import shutil
+
+        for alias, source in json.loads(manifest.read_text()).items():
+            target = Path(folder) / alias
+            if not target.is_file():
+                target.parent.mkdir(parents=True, exist_ok=True)
+                shutil.copyfile(Path(folder) / source, target)
+
     @classmethod
     async def runpy(cls, main, *args, **kw):
         code = ""
@@ -701,6 +715,7 @@ ________________________
         __import__("__main__").__file__ = realpath
         cls.HOME = Path(realpath).parent
         os.chdir(cls.HOME)
+        cls.aliases(cls.HOME)
 
         await cls.preload_code(code, **kw)
 
@@ -27,14 +27,42 @@ import io
 
 import urllib.request
 import hashlib
+import threading
+import asyncio
+import json
+import time
+import atexit
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
 from pathlib import Path
 
 
+from . import caching
+from . import compressing
+
 # on first load be verbose
 VERB = True
 
 CACHE = None
 
+# request metrics endpoint, and optional access log file
+METRICS_PATH = "/__pygbag__/metrics"
+ACCESS_LOG = None
+# common log format, then how the response was produced and its timings
+ACCESS_FORMAT = '{host} - - [{date}] "{request}" {status} {size} {kind} ttfb={ttfb:.1f}ms total={total:.1f}ms'
+LOG_LOCK = threading.Lock()
+
+# rewritten .py/.html bodies, keyed by (path, mtime) and bounded in total size
+REWRITE_CACHE_MAX = 16 * 1024 * 1024
+REWRITE_CACHE = OrderedDict()
+REWRITE_LOCK = threading.Lock()
+
+# larger rewritten pages go to disk, once per file version, and are sent like any file
+REWRITE_DIR = None
+REWRITE_CHUNK = 1024 * 1024
+
 try:
     from future_fstrings import fstring_decode
 except:
@@ -52,7 +80,180 @@ except:
     AUTO_REBUILD = False
 
 
+class Metrics:
+    # per request class : local, cdn, cdn-fill, apk, html, py, listing, metrics
+
+    # histogram upper bounds, in ms
+    BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.kinds = {}
+        self.recent = deque(maxlen=100)
+
+    def timing(self):
+        return {"sum": 0.0, "max": 0.0, "histogram": [0] * (len(self.BUCKETS) + 1)}
+
+    def add(self, timing, ms):
+        timing["sum"] += ms
+        timing["max"] = max(timing["max"], ms)
+        for index, bound in enumerate(self.BUCKETS):
+            if ms <= bound:
+                break
+        else:
+            index = len(self.BUCKETS)
+        timing["histogram"][index] += 1
+
+    def record(self, method, path, kind, status, size, ttfb, total):
+        with self.lock:
+            stats = self.kinds.get(kind)
+            if stats is None:
+                stats = {"requests": 0, "errors": 0, "bytes": 0, "ttfb_ms": self.timing(), "total_ms": self.timing()}
+                self.kinds[kind] = stats
+            stats["requests"] += 1
+            stats["bytes"] += size
+            if status >= 400:
+                stats["errors"] += 1
+            self.add(stats["ttfb_ms"], ttfb)
+            self.add(stats["total_ms"], total)
+            self.recent.append(
+                {
+                    "time": round(time.time(), 3),
+                    "method": method,
+                    "path": path,
+                    "kind": kind,
+                    "status": status,
+                    "bytes": size,
+                    "ttfb_ms": round(ttfb, 3),
+                    "total_ms": round(total, 3),
+                }
+            )
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                "uptime": round(time.time() - self.started, 3),
+                "buckets_ms": list(self.BUCKETS),
+                "kinds": json.loads(json.dumps(self.kinds)),
+                "recent": list(self.recent),
+            }
+
+
+METRICS = Metrics()
+
+
+def rewritten(path, fs, f, rewrite, encoding=""):
+    # content only changes with the file, so rewrite ( and compress ) once per file version
+    # returns content and its etag
+    key = (path, fs.st_mtime_ns, encoding)
+    with REWRITE_LOCK:
+        entry = REWRITE_CACHE.get(key)
+        if entry is not None:
+            REWRITE_CACHE.move_to_end(key)
+            return entry
+
+    if encoding:
+        content = compressing.compress(rewritten(path, fs, f, rewrite)[0], encoding)
+    else:
+        content = rewrite(f.read())
+    entry = content, f'"{hashlib.sha256(content).hexdigest()}"'
+    if len(content) > REWRITE_CACHE_MAX // 4:
+        return entry
+
+    with REWRITE_LOCK:
+        REWRITE_CACHE[key] = entry
+        total = sum(len(content) for content, tag in REWRITE_CACHE.values())
+        while total > REWRITE_CACHE_MAX:
+            old_key, (old, old_tag) = REWRITE_CACHE.popitem(last=False)
+            total -= len(old)
+    return entry
+
+
+def rewrite_stream(read, write, old, new):
+    # replace old by new in a stream, a match may straddle two chunks
+    keep = len(old) - 1
+    pending = b""
+    while chunk := read(REWRITE_CHUNK):
+        data = pending + chunk
+        cut = len(data) - keep
+        if cut <= 0:
+            pending = data
+            continue
+        # do not cut through a match
+        found = data.find(old, max(0, cut - keep), cut + keep)
+        if 0 <= found < cut:
+            cut = found + len(old)
+        write(data[:cut].replace(old, new))
+        pending = data[cut:]
+    write(pending.replace(old, new))
+
+
+def rewritten_file(path, fs, f, encoding=""):
+    # html CDN rewrite streamed to a file, returns its path
+    global REWRITE_DIR
+    with REWRITE_LOCK:
+        if REWRITE_DIR is None:
+            REWRITE_DIR = Path(tempfile.mkdtemp(prefix="pygbag-rewrite-"))
+            atexit.register(shutil.rmtree, REWRITE_DIR, True)
+
+    key = hashlib.sha256(f"{path}:{fs.st_mtime_ns}:{fs.st_size}:{encoding}:{PROXY}".encode()).hexdigest()
+    target = REWRITE_DIR / key
+    if target.is_file():
+        return target
+
+    tmp = REWRITE_DIR / f"{key}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as out:
+        sink = compressing.writer(out, encoding) if encoding else out
+        rewrite_stream(f.read, sink.write, BCDN, BPROXY)
+        if encoding:
+            sink.close()
+    os.replace(tmp, target)
+    return target
+
+
+def rewrite_py(content):
+    content, _ = fstring_decode(content)
+    return content.encode("UTF-8")
+
+
+def rewrite_html(content):
+    # redirect user CDN to localhost
+    return content.replace(BCDN, BPROXY)
+
+
+def byte_range(value, size):
+    # one "bytes=first-last" range as (start, end) inclusive.
+    # None when absent or not supported ( multipart ) so whole file is sent, False when unsatisfiable.
+    if not value or not value.startswith("bytes=") or "," in value:
+        return None
+    first, sep, last = value[6:].strip().partition("-")
+    if not sep:
+        return None
+    try:
+        if first:
+            start = int(first)
+            end = int(last) if last else size - 1
+        else:
+            # suffix range, last n bytes
+            n = int(last)
+            if n <= 0:
+                return False
+            start = max(0, size - n)
+            end = size - 1
+    except ValueError:
+        return None
+    if start < 0:
+        return None
+    if start >= size or end < start:
+        return False
+    return start, min(end, size - 1)
+
+
 class CodeHandler(SimpleHTTPRequestHandler):
+    # headers and body are separate writes, with keep-alive Nagle would hold the body back
+    disable_nagle_algorithm = True
+
     def end_headers(self):
         self.send_header("access-control-allow-origin", "*")
         self.send_header("cross-origin-resource-policy:", "cross-origin")
@@ -66,20 +267,97 @@ class CodeHandler(SimpleHTTPRequestHandler):
         self.send_header("cross-origin-embedder-policy", "require-corp")
 
         super().end_headers()
+        self.first_byte = time.perf_counter()
+
+    def send_response(self, code, message=None):
+        self.status = code
+        super().send_response(code, message)
 
     def do_GET(self):
-        if f := self.send_head():
-            try:
-                self.copyfile(f, self.wfile)
-            finally:
+        f = self.send_head()
+        try:
+            if f:
+                self.send_body(f)
+        finally:
+            self.measure(f)
+            if f:
                 f.close()
 
     def do_HEAD(self):
         if f := self.send_head():
             f.close()
+        self.measure(None)
+
+    def send_body(self, f):
+        if self.byte_range is None or isinstance(f, caching.Follower):
+            # directory listing, or CDN file still downloading
+            self.copyfile(f, self.wfile)
+            return
+        offset, count = self.byte_range
+        if not count:
+            # empty file, sendfile() wants a positive count
+            return
+        f.seek(offset)
+        if isinstance(f, io.BytesIO):
+            self.wfile.write(f.read(count))
+        else:
+            # static and cached files go kernel side, socket.sendfile falls back to send() for ssl
+            self.wfile.flush()
+            self.connection.sendfile(f, offset, count)
+
+    def body_size(self, f):
+        if f is None:
+            return 0
+        if isinstance(f, caching.Follower):
+            return f.pos
+        if self.byte_range:
+            return self.byte_range[1]
+        return len(f.getbuffer())
+
+    def measure(self, f):
+        end = time.perf_counter()
+        ttfb = (self.first_byte or end) - self.started
+        total = end - self.started
+        size = self.body_size(f)
+        METRICS.record(self.command, self.path, self.kind, self.status, size, ttfb * 1000, total * 1000)
+        if ACCESS_LOG:
+            line = ACCESS_FORMAT.format(
+                host=self.address_string(),
+                date=self.log_date_time_string(),
+                request=self.requestline,
+                status=self.status,
+                size=size,
+                kind=self.kind,
+                ttfb=ttfb * 1000,
+                total=total * 1000,
+            )
+            with LOG_LOCK:
+                print(line, file=ACCESS_LOG, flush=True)
+
+    def send_metrics(self):
+        content = json.dumps(METRICS.as_dict(), indent=1).encode()
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-type", "application/json")
+        self.send_header("Cache-Control", "no-store")
+        self.send_header("content-length", str(len(content)))
+        self.end_headers()
+        self.byte_range = (0, len(content))
+        return io.BytesIO(content)
 
     def send_head(self):
         global VERB, CDN, PROXY, BCDN, BPROXY, AUTO_REBUILD
+        self.started = time.perf_counter()
+        self.first_byte = None
+        self.status = 0
+        # request class, for metrics
+        self.kind = "local"
+        # (offset, count) of body to send
+        self.byte_range = None
+
+        if urllib.parse.urlsplit(self.path).path == METRICS_PATH:
+            self.kind = "metrics"
+            return self.send_metrics()
+
         path = self.translate_path(self.path)
         f = None
         if os.path.isdir(path):
@@ -90,6 +368,7 @@ class CodeHandler(SimpleHTTPRequestHandler):
                 new_parts = parts[0], parts[1], f"{parts[2]}/", parts[3], parts[4]
                 new_url = urllib.parse.urlunsplit(new_parts)
                 self.send_header("Location", new_url)
+                self.send_header("Content-Length", "0")
                 self.end_headers()
                 return None
             for index in "index.html", "index.htm":
@@ -98,6 +377,7 @@ class CodeHandler(SimpleHTTPRequestHandler):
                     path = index
                     break
             else:
+                self.kind = "listing"
                 return self.list_directory(path)
 
         ctype = self.guess_type(path)
@@ -107,47 +387,70 @@ class CodeHandler(SimpleHTTPRequestHandler):
             return None
 
         f = None
+        # headers replayed from CDN cache
+        headers = []
+        # file that may have precompressed variants
+        source = None
+        # content hash of a cached CDN file, from its .head
+        digest = None
 
         # .map don't exist and apk is local and could be generated on the fly
         invalid = path.endswith(".map") or path.endswith(".apk")
 
         if not os.path.isfile(path) and not invalid:
             remote_url = CDN + self.path
-            cache = hashlib.md5(remote_url.encode()).hexdigest()
+            cache = caching.cache_key(remote_url)
             d_cache = CACHE.joinpath(f"{cache}.data")
             h_cache = CACHE.joinpath(f"{cache}.head")
-            if not h_cache.is_file():
+            head = None
+            self.kind = "cdn"
+            if not h_cache.is_file() or (caching.INDEX and caching.INDEX.stale(remote_url)):
+                self.kind = "cdn-fill"
                 if VERB:
                     print("CACHING:", remote_url, "->", d_cache)
-                try:
-                    lf, headers = urllib.request.urlretrieve(remote_url, d_cache)
-                    h_cache.write_text(str(headers))
-                except:
+                # rewritten content needs the whole file, anything else is sent while downloading
+                streaming = not path.endswith(".html") and not (self.path.endswith(".py") and fstring_decode)
+                f = caching.fetch(remote_url, d_cache, h_cache, streaming)
+                if f:
+                    head = f.headers
+                elif not h_cache.is_file():
                     print("ERROR 404:", remote_url)
 
-            if d_cache.is_file():
+            if f is None and h_cache.is_file():
                 if VERB:
                     print("CACHED:", remote_url, "from", d_cache)
-                self.send_response(HTTPStatus.OK)
                 f = d_cache.open("rb")
-                with h_cache.open() as fh:
-                    while True:
-                        l = fh.readline()
-                        if l.find(": ") <= 0:
-                            break
-                        k, v = l.strip().split(": ", 1)
-                        k = k.lower()
-                        if k in [
-                            "content-length",
-                            "access-control-allow-origin",
-                            "cross-origin-embedder-policy",
-                            "cross-origin-resource-policy",
-                            "cross-origin-opener-policy",
-                        ]:
-                            continue
-                        self.send_header(k, v)
-                    # we have a cache so not first time, be less verbose
-                    VERB = False
+                source = d_cache
+                head = h_cache.read_text()
+                if caching.INDEX:
+                    caching.INDEX.touch(remote_url)
+
+            if head is not None:
+                for l in head.splitlines():
+                    if l.find(": ") <= 0:
+                        break
+                    k, v = l.strip().split(": ", 1)
+                    k = k.lower()
+                    if k == caching.DIGEST_HEADER:
+                        digest = v
+                        continue
+                    if k in [
+                        "etag",
+                        "content-length",
+                        "access-control-allow-origin",
+                        "cross-origin-embedder-policy",
+                        "cross-origin-resource-policy",
+                        "cross-origin-opener-policy",
+                        "accept-ranges",
+                        "content-range",
+                        "connection",
+                        "keep-alive",
+                        "transfer-encoding",
+                    ]:
+                        continue
+                    headers.append((k, v))
+                # we have a cache so not first time, be less verbose
+                VERB = False
             cached = True
         else:
             cached = False
@@ -156,6 +459,7 @@ class CodeHandler(SimpleHTTPRequestHandler):
             if AUTO_REBUILD:
                 print()
                 print(self.path)
+                self.kind = "apk"
                 AUTO_REBUILD()
                 print()
             else:
@@ -164,6 +468,7 @@ class CodeHandler(SimpleHTTPRequestHandler):
         if f is None:
             try:
                 f = open(path, "rb")
+                source = path
             except OSError:
                 pass
 
@@ -200,23 +505,30 @@ class CodeHandler(SimpleHTTPRequestHandler):
                                 f.close()
                                 return None
 
-                self.send_response(HTTPStatus.OK)
-
-                self.send_header("Content-type", ctype)
+                headers.append(("Content-type", ctype))
+                headers.append(("Last-Modified", self.date_time_string(fs.st_mtime)))
 
             file_size = fs[6]
+            if isinstance(f, caching.Follower):
+                # still downloading
+                file_size = f.length
+
+            tag = None
+            encoding = ""
+            if compressing.compressible(self.path):
+                # representation depends on Accept-Encoding
+                headers.append(("Vary", "Accept-Encoding"))
+                encoding = next(iter(compressing.accepted(self.headers.get("Accept-Encoding"))), "")
 
             if self.path.endswith(".py"):
                 if VERB:
                     print(f" --> do_GET({path})")
                 if fstring_decode:
-                    content, _ = fstring_decode(f.read())
-                    content = content.encode("UTF-8")
-                else:
-                    content = f.read()
-
-                file_size = len(content)
-                f = io.BytesIO(content)
+                    self.kind = "py"
+                    content, tag = rewritten(path, fs, f, rewrite_py, encoding)
+                    file_size = len(content)
+                    f.close()
+                    f = io.BytesIO(content)
 
             elif self.path.endswith(".json"):
                 if VERB:
@@ -227,7 +539,6 @@ class CodeHandler(SimpleHTTPRequestHandler):
             elif path.endswith(".html"):
                 if VERB:
                     print("REPLACING", path, CDN, PROXY)
-                content = f.read()
 
                 # redirect known CDN to relative path
                 # FIXME: py*-scripts
@@ -235,21 +546,87 @@ class CodeHandler(SimpleHTTPRequestHandler):
                 #                    b"https://pygame-web.github.io", b"http://localhost:8000"
                 #                )
 
-                # redirect user CDN to localhost
-                content = content.replace(BCDN, BPROXY)
+                self.kind = "html"
+                if fs.st_size > REWRITE_CACHE_MAX // 4:
+                    # large pages ( --html builds ) would double memory per request
+                    target = rewritten_file(path, fs, f, encoding)
+                    f.close()
+                    f = open(target, "rb")
+                    file_size = os.fstat(f.fileno()).st_size
+                    tag = caching.etag(target, os.fstat(f.fileno()))
+                    if encoding:
+                        headers.append(("Content-Encoding", encoding))
+                    # precompressed variants of source would not be rewritten
+                    source = None
+                else:
+                    content, tag = rewritten(path, fs, f, rewrite_html, encoding)
+                    file_size = len(content)
+                    f.close()
+                    f = io.BytesIO(content)
+
+            if encoding and isinstance(f, io.BytesIO):
+                headers.append(("Content-Encoding", encoding))
+            elif encoding and source:
+                found = compressing.negotiate(source, self.headers.get("Accept-Encoding"), fs)
+                if found:
+                    encoding, target = found
+                    f.close()
+                    f = open(target, "rb")
+                    file_size = os.fstat(f.fileno()).st_size
+                    headers.append(("Content-Encoding", encoding))
+                    digest = None
+
+            if tag is None and source:
+                # file as is, or its precompressed variant
+                tag = caching.etag(f.name, os.fstat(f.fileno()), digest)
+
+            if tag:
+                headers.append(("ETag", tag))
+                if "If-None-Match" in self.headers and caching.matches(self.headers["If-None-Match"], tag):
+                    self.send_response(HTTPStatus.NOT_MODIFIED)
+                    for k, v in headers:
+                        if k.lower() in ("etag", "vary", "last-modified", "cache-control", "expires", "date"):
+                            self.send_header(k, v)
+                    self.end_headers()
+                    f.close()
+                    return None
+
+            requested = byte_range(self.headers.get("Range"), file_size)
+            if isinstance(f, caching.Follower):
+                # whole body only, while downloading
+                requested = None
+            if requested is not None and "If-Range" in self.headers:
+                # resume only if client copy is still the same
+                validators = [v for k, v in headers if k.lower() in ("last-modified", "etag")]
+                if self.headers["If-Range"] not in validators:
+                    requested = None
+
+            if requested is False:
+                self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                self.send_header("Content-Range", f"bytes */{file_size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                f.close()
+                return None
 
-                file_size = len(content)
-                f = io.BytesIO(content)
+            if requested:
+                start, end = requested
+                self.send_response(HTTPStatus.PARTIAL_CONTENT)
+                self.send_header("Content-Range", f"bytes {start}-{end}/{file_size}")
+            else:
+                start, end = 0, file_size - 1
+                self.send_response(HTTPStatus.OK)
 
-            self.send_header("content-length", str(file_size))
+            for k, v in headers:
+                self.send_header(k, v)
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("content-length", str(end - start + 1))
             # self.send_header("Access-Control-Allow-Origin", "*")
             # self.send_header("Cross-Origin-Embedder-Policy", "require-corp")
 
-            if not cached:
-                self.send_header("Last-Modified", self.date_time_string(fs.st_mtime))
-
             self.end_headers()
 
+            self.byte_range = (start, end - start + 1)
             return f
         except:
             f.close()
@@ -259,7 +636,7 @@ class CodeHandler(SimpleHTTPRequestHandler):
 def code_server(
     HandlerClass,
     ServerClass=ThreadingHTTPServer,
-    protocol="HTTP/1.0",
+    protocol="HTTP/1.1",
     port=8000,
     bind="localhost",
     ssl=False,
@@ -270,7 +647,8 @@ def code_server(
 
     server_address = (bind, port)
 
-    HandlerClass.protocol_version = protocol
+    # HandlerClass is usually a partial, version must be set on the class itself
+    getattr(HandlerClass, "func", HandlerClass).protocol_version = protocol
 
     with ServerClass(server_address, HandlerClass) as httpd:
         sa = httpd.socket.getsockname()
@@ -302,6 +680,133 @@ def code_server(
             sys.exit(0)
 
 
+class AsyncCodeHandler(CodeHandler):
+    """
+    CodeHandler for one request read by the asyncio server.
+    headers and small bodies are written to a BytesIO, files are returned to the loop for sending.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def __init__(self, head, client_address, directory):
+        self.client_address = client_address
+        self.directory = directory
+        self.server = None
+        self.request = None
+        self.connection = None
+        self.rfile = io.BytesIO(head)
+        self.wfile = io.BytesIO()
+        self.close_connection = True
+        self.byte_range = None
+        # set by send_head, requests rejected before are not measured
+        self.started = None
+
+    def prepare(self):
+        # blocking parts of handle_one_request(), runs in a worker thread
+        self.raw_requestline = self.rfile.readline(65537)
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ""
+            self.request_version = ""
+            self.command = ""
+            self.send_error(HTTPStatus.REQUEST_URI_TOO_LONG)
+            return None
+
+        if not self.parse_request():
+            return None
+
+        if self.command not in ("GET", "HEAD"):
+            self.send_error(HTTPStatus.NOT_IMPLEMENTED, f"Unsupported method ({self.command!r})")
+            return None
+
+        f = self.send_head()
+        if f and self.command == "HEAD":
+            f.close()
+            return None
+        return f
+
+
+async def serve_client(reader, writer, directory, executor):
+    loop = asyncio.get_running_loop()
+    peer = writer.get_extra_info("peername")
+    try:
+        while True:
+            try:
+                head = await reader.readuntil(b"\r\n\r\n")
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                break
+
+            handler = AsyncCodeHandler(head, peer, directory)
+            f = await loop.run_in_executor(executor, handler.prepare)
+            writer.write(handler.wfile.getvalue())
+            handler.first_byte = time.perf_counter()
+            try:
+                if f is None:
+                    pass
+                elif handler.byte_range is None:
+                    # directory listing
+                    writer.write(f.getvalue())
+                elif isinstance(f, caching.Follower):
+                    # CDN file still downloading
+                    while data := await loop.run_in_executor(executor, f.read, caching.CHUNK):
+                        writer.write(data)
+                        await writer.drain()
+                else:
+                    offset, count = handler.byte_range
+                    if isinstance(f, io.BytesIO):
+                        writer.write(f.getbuffer()[offset : offset + count])
+                    else:
+                        await writer.drain()
+                        # os.sendfile when possible, else reads from the executor
+                        await loop.sendfile(writer.transport, f, offset, count or None)
+                await writer.drain()
+            finally:
+                if handler.started:
+                    handler.measure(f)
+                if f:
+                    f.close()
+
+            if handler.close_connection:
+                break
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def async_code_server(directory, port=8000, bind="localhost", ssl=False, workers=32):
+    """
+    Same as code_server but connections are coroutines, only file system and CDN work use threads.
+    """
+    context = None
+    if ssl:
+        import ssl as modssl
+
+        try:
+            context = modssl.SSLContext(modssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(certfile="server.pem", keyfile="key.pem")
+        except Exception as e:
+            print("can't start ssl", e)
+            print("maybe 'openssl req -new -x509 -keyout key.pem -out server.pem -days 3650 -nodes'")
+            context = None
+
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pygbag-io")
+    client = partial(serve_client, directory=directory, executor=executor)
+    server = await asyncio.start_server(client, bind, port, ssl=context, backlog=1024)
+
+    sa = server.sockets[0].getsockname()
+    if context:
+        serve_message = "Serving HTTPS on {host} port {port} (https://{host}:{port}/) with asyncio ..."
+    else:
+        serve_message = "Serving HTTP on {host} port {port} (http://{bind}:{port}/) with asyncio ..."
+    print(serve_message.format(host=sa[0], port=sa[1], bind=bind))
+
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        executor.shutdown(wait=False)
+
+
 if ".wasm" not in CodeHandler.extensions_map:
     print(
         "WARNING: wasm mimetype unsupported on that system, trying to correct",
@@ -310,9 +815,14 @@ if ".wasm" not in CodeHandler.extensions_map:
     CodeHandler.extensions_map[".wasm"] = "application/wasm"
 
 
-def run_code_server(args, cc):
-    global CACHE, CDN, PROXY, BCDN, BPROXY
+def configure(args, cc):
+    global CACHE, CDN, PROXY, BCDN, BPROXY, ACCESS_LOG
     CACHE = Path(args.cache)
+    if args.access_log == "-":
+        ACCESS_LOG = sys.stdout
+    elif args.access_log:
+        ACCESS_LOG = open(args.access_log, "a")
+    caching.INDEX = caching.Index(CACHE, args.cache_size * 1024 * 1024)
     CDN = "/".join(args.cdn.split("/")[:3])
     PROXY = cc["proxy"]
 
@@ -330,5 +840,17 @@ def run_code_server(args, cc):
             ssl = False
     else:
         print("Not using SSL")
+    if AUTO_REBUILD:
+        pack.watch()
+    return ssl
+
+
+def run_code_server(args, cc):
+    ssl = configure(args, cc)
     handler_class = partial(CodeHandler, directory=args.directory)
     code_server(HandlerClass=handler_class, port=args.port, bind=args.bind, ssl=ssl)
+
+
+async def run_async_code_server(args, cc):
+    ssl = configure(args, cc)
+    await async_code_server(args.directory, port=args.port, bind=args.bind, ssl=ssl)
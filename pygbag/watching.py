@@ -0,0 +1,170 @@
+import os
+import sys
+import struct
+import threading
+from pathlib import Path
+
+from .gathering import gather
+
+# inotify(7) flags
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+
+IN_WATCH = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+EVENT = struct.Struct("iIII")
+
+
+def inotify():
+    # libc inotify through ctypes, None when not available on that system
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        import ctypes
+        import ctypes.util
+
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (ImportError, OSError, AttributeError):
+        return None
+    return libc
+
+
+class Watcher:
+    # tracks files changed under root since last call to changes()
+    # inotify when possible, else a stat scan done only when changes() is called.
+
+    def __init__(self, root, rules=None):
+        self.root = Path(root)
+        self.rules = rules
+        self.lock = threading.Lock()
+        self.dirty = set()
+        self.everything = False
+        self.mode = None
+        self.snapshot = {}
+        self.fd = -1
+        self.libc = None
+        self.folders = {}
+
+    def start(self):
+        libc = inotify()
+        if libc:
+            fd = libc.inotify_init1(os.O_CLOEXEC)
+            if fd >= 0:
+                self.libc = libc
+                self.fd = fd
+                if self.watch_tree("/"):
+                    self.mode = "inotify"
+                    threading.Thread(target=self.loop, name="pygbag-watcher", daemon=True).start()
+                    return self
+                # probably out of watches ( fs.inotify.max_user_watches )
+                os.close(fd)
+                self.fd = -1
+
+        self.mode = "poll"
+        self.snapshot = self.scan()
+        return self
+
+    def skip_folder(self, rel):
+        return self.rules and self.rules.skip_folder(rel)
+
+    def skip_file(self, rel):
+        return self.rules and self.rules.skip_file(rel)
+
+    def watch_tree(self, rel):
+        for current, dirnames, filenames in os.walk(self.root.joinpath(rel.lstrip("/"))):
+            sub = Path("/").joinpath(Path(current).relative_to(self.root)).as_posix()
+            dirnames[:] = [dirname for dirname in dirnames if not self.skip_folder(f"{sub.rstrip('/')}/{dirname}")]
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(current), IN_WATCH)
+            if wd < 0:
+                return False
+            self.folders[wd] = sub.rstrip("/")
+        return True
+
+    def loop(self):
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except OSError:
+                return
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, size = EVENT.unpack_from(data, offset)
+                offset += EVENT.size
+                name = data[offset : offset + size].rstrip(b"\0").decode("utf-8", "surrogateescape")
+                offset += size
+                self.event(wd, mask, name)
+
+    def event(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            # events were lost
+            with self.lock:
+                self.everything = True
+            return
+
+        if mask & IN_IGNORED:
+            self.folders.pop(wd, None)
+            return
+
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            with self.lock:
+                self.everything = True
+            return
+
+        folder = self.folders.get(wd)
+        if folder is None:
+            return
+
+        rel = f"{folder}/{name}" if name else folder
+        if mask & IN_ISDIR:
+            if self.skip_folder(rel) or not mask & (IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO):
+                return
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self.watch_tree(rel)
+            # folder content appeared or vanished as a whole
+            with self.lock:
+                self.everything = True
+            return
+
+        if not name or self.skip_file(rel):
+            return
+
+        with self.lock:
+            self.dirty.add(rel)
+
+    def scan(self):
+        snapshot = {}
+        for folder, assets in gather(self.root, rules=self.rules):
+            for asset in assets:
+                if self.skip_file(asset.name):
+                    continue
+                snapshot[asset.name] = (asset.stat.st_size, asset.stat.st_mtime_ns)
+        return snapshot
+
+    def changes(self):
+        # returns the set of changed file names, or None when anything may have changed
+        if self.mode == "poll":
+            snapshot = self.scan()
+            previous = self.snapshot
+            self.snapshot = snapshot
+            return set(name for name in snapshot.keys() | previous.keys() if snapshot.get(name) != previous.get(name))
+
+        with self.lock:
+            dirty = self.dirty
+            everything = self.everything
+            self.dirty = set()
+            self.everything = False
+        if everything:
+            return None
+        return dirty
@@ -0,0 +1,190 @@
+import os
+import time
+import threading
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from pygbag import caching
+
+BODY = bytes(range(256)) * 1024
+
+
+class Upstream(BaseHTTPRequestHandler):
+    # slow enough that every client arrives while the first download runs
+    hits = None
+
+    def do_GET(self):
+        self.hits.append(self.path)
+        if self.path == "/fail.bin":
+            self.send_error(500)
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(BODY)))
+        self.end_headers()
+        body = BODY[:1000] if self.path == "/short.bin" else BODY
+        for pos in range(0, len(body), 32 * 1024):
+            self.wfile.write(body[pos : pos + 32 * 1024])
+            self.wfile.flush()
+            time.sleep(0.01)
+
+    def log_message(self, *argv):
+        pass
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    monkeypatch.setattr(caching, "INDEX", None)
+    monkeypatch.setattr(caching, "OFFLINE", False)
+    hits = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), type("Handler", (Upstream,), {"hits": hits}))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}", hits
+    server.shutdown()
+    server.server_close()
+
+
+def entry(folder, url):
+    key = caching.cache_key(url)
+    return folder / f"{key}.data", folder / f"{key}.head"
+
+
+def client(url, data, head, streaming):
+    f = caching.fetch(url, data, head, streaming)
+    if f is None:
+        return data.read_bytes() if head.is_file() else None
+    body = []
+    while chunk := f.read(caching.CHUNK):
+        body.append(chunk)
+    f.close()
+    return b"".join(body)
+
+
+@pytest.mark.parametrize("streaming", [True, False])
+def test_single_flight(tmp_path, upstream, streaming):
+    base, hits = upstream
+    url = f"{base}/data.bin"
+    data, head = entry(tmp_path, url)
+    barrier = threading.Barrier(6)
+    bodies = []
+
+    def run():
+        barrier.wait()
+        bodies.append(client(url, data, head, streaming))
+
+    threads = [threading.Thread(target=run) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert hits == ["/data.bin"]
+    assert len(bodies) == 6 and all(body == BODY for body in bodies)
+    assert data.read_bytes() == BODY
+    assert f"{caching.DIGEST_HEADER}: " in head.read_text()
+    assert not list(tmp_path.glob("*.tmp*"))
+
+    # complete entry, no new download
+    assert client(url, data, head, streaming) == BODY
+    assert hits == ["/data.bin"]
+
+
+@pytest.mark.parametrize("path", ["/fail.bin", "/short.bin"])
+@pytest.mark.parametrize("streaming", [True, False])
+def test_failed_fill(tmp_path, upstream, path, streaming):
+    base, hits = upstream
+    url = f"{base}{path}"
+    data, head = entry(tmp_path, url)
+    f = caching.fetch(url, data, head, streaming)
+    if f is not None:
+        # the follower reports it, a partial body is never taken for the file
+        with pytest.raises(OSError):
+            while f.read(caching.CHUNK):
+                pass
+        f.close()
+    for attempt in range(100):
+        if url not in caching.FILLS:
+            break
+        time.sleep(0.01)
+
+    assert not head.exists()
+    assert not data.exists()
+    assert not list(tmp_path.glob("*.tmp*"))
+
+
+def index_entry(index, url, size, accessed):
+    data, head = entry(index.folder, url)
+    data.write_bytes(b"x" * size)
+    head.write_text("\n")
+    index.record(url, size, {}, None)
+    index.query("update entries set accessed=? where url=?", accessed, url)
+    return data, head
+
+
+def test_evict_least_recently_accessed(tmp_path):
+    index = caching.Index(tmp_path)
+    # recorded in url order, accessed in another one
+    accessed = {"a": 5, "b": 1, "c": 4, "d": 2, "e": 3}
+    files = {name: index_entry(index, f"https://cdn/{name}", 300, when) for name, when in accessed.items()}
+
+    index.max_size = 1000
+    index.evict()
+    # 1500 bytes down to at most 900 : the two least recently used go
+    kept = {url.rsplit("/", 1)[1] for (url,) in index.query("select url from entries")}
+    assert kept == {"a", "c", "e"}
+    assert index.query("select sum(size) from entries")[0][0] <= 1000 * caching.EVICT_RATIO
+    for name, (data, head) in files.items():
+        assert data.exists() == head.exists() == (name in kept)
+
+
+@pytest.mark.parametrize("version, other", [("0.9.2", "0.9.3"), ("1.0", "1.1")])
+def test_upgrade(tmp_path, version, other):
+    index = caching.Index(tmp_path)
+    assert index.upgrade(version)
+    epoch = index.epoch()
+    assert epoch
+
+    # same version : nothing invalidated
+    assert not index.upgrade(version)
+    assert index.epoch() == epoch
+    # also for another process sharing the folder
+    assert not caching.Index(tmp_path).upgrade(version)
+
+    assert index.upgrade(other)
+    assert index.epoch() >= epoch
+
+
+def test_invalidate(tmp_path):
+    index = caching.Index(tmp_path)
+    url = "https://cdn/indexed.js"
+    data, head = index_entry(index, url, 10, time.time())
+    assert not index.stale(url)
+
+    old = time.time() - 3600
+    unindexed = tmp_path / "0123.data"
+    partial = tmp_path / "4567.data.1.2.tmp"
+    for path in (unindexed, partial, data, head):
+        path.write_bytes(b"x")
+        os.utime(path, (old, old))
+    # download of another process, finished after the epoch and not yet indexed
+    recent = tmp_path / "89ab.data"
+    recent.write_bytes(b"x")
+    os.utime(recent, (time.time() + 60, time.time() + 60))
+
+    index.invalidate()
+    assert not unindexed.exists()
+    assert partial.exists() and recent.exists()
+    assert data.exists() and head.exists()
+    assert (tmp_path / "index.sqlite").exists()
+    # kept, but revalidated on next use
+    assert index.stale(url)
+
+
+def test_invalidate_prefix(tmp_path):
+    index = caching.Index(tmp_path)
+    index_entry(index, "https://cdn/a.js", 10, time.time())
+    index_entry(index, "https://other/b.js", 10, time.time())
+    index.invalidate("https://cdn/")
+    assert index.stale("https://cdn/a.js")
+    assert not index.stale("https://other/b.js")
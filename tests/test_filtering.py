@@ -0,0 +1,73 @@
+import re
+
+import pytest
+
+from pygbag.filtering import translate, Rules
+
+
+@pytest.mark.parametrize(
+    "pattern, path, matched",
+    [
+        # no slash : any depth
+        ("*.tmp", "a.tmp", True),
+        ("*.tmp", "deep/er/a.tmp", True),
+        ("*.tmp", "a.tmpx", False),
+        # a slash anchors to app folder
+        ("/todo.txt", "todo.txt", True),
+        ("/todo.txt", "docs/todo.txt", False),
+        ("docs/*.md", "docs/a.md", True),
+        ("docs/*.md", "docs/sub/a.md", False),
+        ("docs/*.md", "other/docs/a.md", False),
+        # ** spans folders
+        ("**/cache", "cache", True),
+        ("**/cache", "a/b/cache", True),
+        ("docs/**/a.md", "docs/a.md", True),
+        ("docs/**/a.md", "docs/x/y/a.md", True),
+        ("docs/**", "docs/x/y", True),
+        # single character and classes
+        ("file?.txt", "file1.txt", True),
+        ("file?.txt", "file/.txt", False),
+        ("[ab].png", "b.png", True),
+        ("[!ab].png", "b.png", False),
+        ("[!ab].png", "c.png", True),
+        # escapes and regex characters are literal
+        ("\\#notes", "#notes", True),
+        ("a+b.(c)", "a+b.(c)", True),
+        ("a+b.(c)", "aab.(c)", False),
+        ("[unclosed", "[unclosed", True),
+    ],
+)
+def test_translate(pattern, path, matched):
+    assert bool(re.fullmatch(translate(pattern), path)) is matched
+
+
+def test_rules(tmp_path):
+    (tmp_path / ".gitignore").write_text("# comment\n\n*.log\n!keep.log\nassets/raw/\n/secret.txt\n")
+    (tmp_path / "pygbag.ignore").write_text("*.psd\n")
+    rules = Rules(tmp_path)
+
+    assert rules.skip_file("/x/debug.log")
+    assert not rules.skip_file("/x/keep.log")
+    assert rules.skip_file("/art/cover.psd")
+    assert rules.skip_file("/secret.txt")
+    assert not rules.skip_file("/sub/secret.txt")
+
+    # trailing slash : folders only, and whatever is below
+    assert rules.skip_folder("/assets/raw")
+    assert rules.skip_folder("/assets/raw/deep")
+    assert not rules.skip_file("/assets/raw")
+    assert not rules.skip_folder("/assets")
+
+    # built-in rules
+    assert rules.skip_folder("/build")
+    assert rules.skip_folder("/.git/objects")
+    assert rules.skip_file("/mod.PYC")
+    assert rules.skip_file("/sub/.gitignore")
+    assert not rules.skip_file("/main.py")
+    assert not rules.skip_folder("/")
+
+
+def test_no_rules():
+    rules = Rules()
+    assert not rules.skip_file("/a.log.txt")
+    assert not rules.skip_folder("/src")
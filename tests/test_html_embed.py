@@ -0,0 +1,72 @@
+import io
+import json
+import os
+import sys
+import subprocess
+
+from pygbag import html_embed
+from pygbag.gathering import Asset
+
+# runs after the embedded filesystem, in its own interpreter : it patches open and os
+CHECK = """
+import os, sys, json
+vfs = sys.modules["pygbag_vfs"]
+pending = sorted(vfs.index)
+found = {}
+for name in ("data/a.bin", "data/b.bin", "data/kept.bin", "data/c.bin"):
+    with open(name, "rb") as file:
+        found[name] = file.read().decode()
+print(json.dumps({"pending": pending, "found": found, "left": sorted(vfs.index)}))
+"""
+
+
+def embed(root, files):
+    packlist = []
+    for name, data in files.items():
+        path = root / "app" / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+        packlist.append(Asset(f"/{name}", path, path.stat()))
+    html = io.StringIO()
+    html_embed.dump_fs(html, root / "app", packlist)
+    return html.getvalue()
+
+
+def run(root, script):
+    # the embedded filesystem lives in the temp folder
+    home = root / "home"
+    home.mkdir(exist_ok=True)
+    env = dict(os.environ, TMPDIR=str(home))
+    out = subprocess.run([sys.executable, "-c", script + CHECK], env=env, capture_output=True, text=True, check=True)
+    lines = out.stdout.strip().split("\n")
+    return lines[:-1], json.loads(lines[-1])
+
+
+def test_lazy_decode_and_alias(tmp_path):
+    script = embed(tmp_path, {"data/a.bin": b"same", "data/b.bin": b"same", "data/kept.bin": b"new", "data/c.bin": b"other"})
+    # second copy only refers to the first one
+    assert "fs_alias('data/b.bin','data/a.bin')" in script
+
+    (tmp_path / "home" / "data").mkdir(parents=True)
+    (tmp_path / "home" / "data" / "kept.bin").write_text("old")
+
+    logs, result = run(tmp_path, script)
+    assert result["pending"] == ["data/a.bin", "data/b.bin", "data/c.bin"]
+    assert result["found"] == {"data/a.bin": "same", "data/b.bin": "same", "data/kept.bin": "old", "data/c.bin": "other"}
+    assert result["left"] == []
+    assert logs == []
+
+
+def test_alias_over_existing_file(tmp_path):
+    script = embed(tmp_path, {"data/a.bin": b"same", "data/b.bin": b"same", "data/kept.bin": b"x", "data/c.bin": b"y"})
+    home = tmp_path / "home" / "data"
+    home.mkdir(parents=True)
+    # alias target kept and reported, alias of a source kept from disk copies it
+    (home / "b.bin").write_text("mine")
+    (home / "a.bin").write_text("disk")
+    script = script.replace("fs_alias('data/b.bin','data/a.bin')", "fs_alias('data/b.bin','data/a.bin')\nfs_alias('data/d.bin','data/a.bin')")
+
+    logs, result = run(tmp_path, script)
+    assert result["found"]["data/b.bin"] == "mine"
+    assert logs == ["fs_alias: data/b.bin exists, not replaced by a copy of data/a.bin"]
+    assert (home / "d.bin").read_text() == "disk"
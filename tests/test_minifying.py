@@ -0,0 +1,65 @@
+import ast
+
+import pytest
+
+from pygbag import minifying
+
+SOURCE = '''#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""module docstring
+on two lines"""
+import os  # trailing comment
+
+
+def f(x):
+    """docstring"""
+    # comment
+    assert x, "no x"
+    text = """kept
+    # not a comment
+    """
+    return text
+
+
+class C:
+    "only a docstring"
+
+
+def g():
+    return f(1)  # last
+'''
+
+
+def linenos(text):
+    return {node.name: node.lineno for node in ast.walk(ast.parse(text)) if isinstance(node, (ast.FunctionDef, ast.ClassDef))}
+
+
+@pytest.mark.parametrize("asserts", [False, True])
+def test_lines_are_kept(asserts):
+    text = minifying.minify(SOURCE, asserts)
+    before = SOURCE.split("\n")
+    after = text.split("\n")
+    assert len(after) == len(before)
+    assert linenos(text) == linenos(SOURCE)
+    # every line left is the original one, blank, or pass in a block left empty
+    for old, new in zip(before, after):
+        assert new in ("", "    pass") or old.startswith(new)
+
+
+def test_stripped():
+    text = minifying.minify(SOURCE)
+    assert text.startswith("#!/usr/bin/env python\n# -*- coding: utf-8 -*-\n\n\nimport os\n")
+    assert "docstring" not in text
+    assert "# comment" not in text and "# last" not in text
+    # strings are code, even when they look like comments
+    assert '    # not a comment\n' in text
+    # a block can't be empty
+    assert "class C:\n    pass\n" in text
+    assert "assert x" in text
+    assert "assert x" not in minifying.minify(SOURCE, asserts=True)
+
+
+def test_shared_line_raises():
+    # documented limitation, minify_all then ships that module as is
+    with pytest.raises(SyntaxError):
+        minifying.minify("if x:\n    assert x; y = 2\n", asserts=True)
@@ -0,0 +1,74 @@
+import os
+import random
+import zipfile
+
+import pytest
+
+from pygbag import pack
+from pygbag.gathering import Asset
+
+
+def make_tree(root, seed=0):
+    rng = random.Random(seed)
+    files = {
+        "main.py": b"import asyncio\n" * 20,
+        "data/level.txt": b"".join(b"%d\n" % rng.randrange(1000) for i in range(2000)),
+        "img/noise.bin": rng.getrandbits(8 * 20000).to_bytes(20000, "little"),
+        "empty.txt": b"",
+    }
+    for name, data in files.items():
+        path = root / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+    return packlist(root)
+
+
+def packlist(root):
+    return [Asset("/" + path.relative_to(root).as_posix(), path, path.stat()) for path in sorted(root.rglob("*")) if path.is_file()]
+
+
+def reference(apk, assets):
+    # what a plain zipfile build gives
+    with zipfile.ZipFile(apk, "x", compression=zipfile.ZIP_DEFLATED, compresslevel=pack.COMPRESSLEVEL) as zf:
+        for asset in assets:
+            zf.write(asset.path, "assets/" + asset.name[1:])
+    return apk.read_bytes()
+
+
+@pytest.mark.parametrize("raw", [True, False])
+def test_same_bytes_as_zipfile(tmp_path, monkeypatch, raw):
+    if raw:
+        with zipfile.ZipFile(tmp_path / "probe.zip", "w") as zf:
+            if not pack.raw_writable(zf):
+                pytest.skip("zipfile internals changed, only the fallback can run")
+    else:
+        monkeypatch.setattr(pack, "raw_writable", lambda zf: False)
+
+    root = tmp_path / "app"
+    assets = make_tree(root)
+    apk = tmp_path / "app.apk"
+    pack.pack_apk(apk, assets, root, manifest=tmp_path / "app.json", jobs=1)
+    assert apk.read_bytes() == reference(tmp_path / "ref.apk", assets)
+
+
+def test_incremental_rebuild(tmp_path, capsys):
+    root = tmp_path / "app"
+    assets = make_tree(root)
+    apk = tmp_path / "app.apk"
+    manifest = tmp_path / "app.json"
+    pack.pack_apk(apk, assets, root, manifest=manifest, jobs=1)
+
+    # one edit, one touch without change
+    (root / "data/level.txt").write_bytes(b"changed\n")
+    os.utime(root / "img/noise.bin", (1700000000, 1700000000))
+    capsys.readouterr()
+    assets = packlist(root)
+    pack.pack_apk(apk, assets, root, manifest=manifest, jobs=1)
+    assert "reused 3 unchanged members" in capsys.readouterr().out
+    assert apk.read_bytes() == reference(tmp_path / "ref.apk", assets)
+
+
+def test_parallel_deflate_keeps_order(tmp_path):
+    assets = make_tree(tmp_path / "app")
+    filenames = [asset.path for asset in assets] * 3
+    assert list(pack.deflate_all(filenames, jobs=4)) == list(pack.deflate_all(filenames, jobs=1))
@@ -0,0 +1,231 @@
+import io
+import os
+import socket
+import asyncio
+import hashlib
+import threading
+import http.client
+from functools import partial
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+from pygbag import caching, testserver
+
+DATA = bytes(range(256)) * 40
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def threaded(folder):
+    handler = partial(testserver.CodeHandler, directory=str(folder))
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def stop():
+        server.shutdown()
+        server.server_close()
+
+    return server.server_address[1], stop
+
+
+def asynchronous(folder):
+    port = free_port()
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    asyncio.run_coroutine_threadsafe(testserver.async_code_server(str(folder), port=port, bind="127.0.0.1"), loop)
+    for attempt in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            break
+        except OSError:
+            threading.Event().wait(0.02)
+
+    async def cancel():
+        # server and its client coroutines
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stop():
+        asyncio.run_coroutine_threadsafe(cancel(), loop).result(10)
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+    return port, stop
+
+
+@pytest.fixture(params=[threaded, asynchronous], ids=["threaded", "asyncio"])
+def server(request, tmp_path, monkeypatch):
+    monkeypatch.setattr(testserver, "VERB", False)
+    monkeypatch.setattr(testserver, "CACHE", tmp_path / "cache")
+    monkeypatch.setattr(testserver, "ACCESS_LOG", None)
+    # unreachable, CDN files only come from cache
+    monkeypatch.setattr(testserver, "CDN", "http://127.0.0.1:9", raising=False)
+    monkeypatch.setattr(caching, "INDEX", None)
+    monkeypatch.setattr(caching, "OFFLINE", True)
+    monkeypatch.setattr(testserver.CodeHandler, "protocol_version", "HTTP/1.1")
+    monkeypatch.setattr(testserver.CodeHandler, "log_message", lambda *argv: None)
+    folder = tmp_path / "web"
+    folder.mkdir()
+    (folder / "data.bin").write_bytes(DATA)
+    (folder / "empty.txt").write_bytes(b"")
+    cdn_entry(tmp_path / "cache", "/cdn.bin", DATA[::-1])
+    port, stop = request.param(folder)
+    # one connection for the whole test, responses must keep it usable
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    yield connection
+    connection.close()
+    stop()
+
+
+def cdn_entry(cache, path, data):
+    # what a completed fill leaves in cache
+    key = caching.cache_key(testserver.CDN + path)
+    cache.mkdir(exist_ok=True)
+    (cache / f"{key}.data").write_bytes(data)
+    digest = hashlib.sha256(data).hexdigest()
+    (cache / f"{key}.head").write_text(f'content-type: application/octet-stream\netag: "upstream"\n{caching.DIGEST_HEADER}: {digest}\n\n')
+
+
+def get(connection, path, **headers):
+    connection.request("GET", path, headers={k.replace("_", "-"): v for k, v in headers.items()})
+    response = connection.getresponse()
+    return response, response.read()
+
+
+@pytest.mark.parametrize(
+    "value, size, expected",
+    [
+        (None, 100, None),
+        ("bytes=0-9", 100, (0, 9)),
+        ("bytes=90-", 100, (90, 99)),
+        ("bytes=90-1000", 100, (90, 99)),
+        ("bytes=-10", 100, (90, 99)),
+        ("bytes=-1000", 100, (0, 99)),
+        ("bytes=100-", 100, False),
+        ("bytes=5-4", 100, False),
+        ("bytes=-0", 100, False),
+        ("bytes=0-1,5-6", 100, None),
+        ("items=0-9", 100, None),
+        ("bytes=x-9", 100, None),
+    ],
+)
+def test_byte_range(value, size, expected):
+    assert testserver.byte_range(value, size) == expected
+
+
+def test_range(server):
+    response, body = get(server, "/data.bin")
+    assert response.status == 200
+    assert response.getheader("Accept-Ranges") == "bytes"
+    assert body == DATA
+
+    response, body = get(server, "/data.bin", Range="bytes=10-19")
+    assert response.status == 206
+    assert response.getheader("Content-Range") == f"bytes 10-19/{len(DATA)}"
+    assert body == DATA[10:20]
+
+    # no body at all, and the connection stays usable
+    response, body = get(server, "/empty.txt")
+    assert response.status == 200
+    assert body == b""
+
+    response, body = get(server, "/data.bin", Range="bytes=-5")
+    assert response.status == 206
+    assert body == DATA[-5:]
+
+    response, body = get(server, "/data.bin", Range=f"bytes={len(DATA)}-")
+    assert response.status == 416
+    assert response.getheader("Content-Range") == f"bytes */{len(DATA)}"
+    assert body == b""
+
+
+def test_if_range(server):
+    response, body = get(server, "/data.bin")
+    modified = response.getheader("Last-Modified")
+
+    # still the same copy : resume
+    response, body = get(server, "/data.bin", Range="bytes=100-", If_Range=modified)
+    assert response.status == 206
+    assert body == DATA[100:]
+
+    # client copy is outdated : whole file
+    response, body = get(server, "/data.bin", Range="bytes=100-", If_Range="Thu, 01 Jan 1981 00:00:00 GMT")
+    assert response.status == 200
+    assert body == DATA
+
+
+OLD = b"https://cdn"
+NEW = b"http://localhost:8000/https://cdn"
+
+
+@pytest.mark.parametrize("chunk", [1, 2, 3, 5, 10, 11, 12, 64])
+@pytest.mark.parametrize(
+    "data",
+    [
+        b"",
+        OLD,
+        b"x" + OLD,
+        OLD + OLD,
+        b"<a " + OLD + b"/a.js> <b " + OLD + b"/b.js>" * 3,
+        # partial matches close to real ones
+        b"https://cd" + OLD + b"https://c",
+        b"".join(b"%s%s" % (b"y" * n, OLD) for n in range(13)),
+    ],
+    ids=lambda value: str(len(value)),
+)
+def test_rewrite_stream(monkeypatch, chunk, data):
+    # matches straddle chunk boundaries at every offset, and replacement contains the pattern
+    monkeypatch.setattr(testserver, "REWRITE_CHUNK", chunk)
+    out = io.BytesIO()
+    testserver.rewrite_stream(io.BytesIO(data).read, out.write, OLD, NEW)
+    assert out.getvalue() == data.replace(OLD, NEW)
+
+
+@pytest.mark.parametrize("path", ["/data.bin", "/cdn.bin"])
+def test_etag(server, path):
+    response, body = get(server, path)
+    tag = response.getheader("ETag")
+    assert response.status == 200
+    # strong, and the same for an unchanged file
+    assert tag.startswith('"') and tag.endswith('"')
+    assert get(server, path)[0].getheader("ETag") == tag
+    if path == "/cdn.bin":
+        # content hash recorded by the fill, not the upstream tag
+        assert tag == f'"{hashlib.sha256(body).hexdigest()}"'
+
+    for value in (tag, f"W/{tag}", f'"other", {tag}', "*"):
+        response, body = get(server, path, If_None_Match=value)
+        assert response.status == 304, value
+        assert response.getheader("ETag") == tag
+        assert body == b""
+
+    response, body = get(server, path, If_None_Match='"other"')
+    assert response.status == 200
+    assert len(body) == len(DATA)
+
+    # If-Range needs a strong match
+    response, body = get(server, path, Range="bytes=0-9", If_Range=tag)
+    assert response.status == 206
+    response, body = get(server, path, Range="bytes=0-9", If_Range=f"W/{tag}")
+    assert response.status == 200
+
+
+def test_etag_follows_content(server, tmp_path):
+    tag = get(server, "/data.bin")[0].getheader("ETag")
+    target = tmp_path / "web" / "data.bin"
+    target.write_bytes(DATA[:-1] + b"!")
+    os.utime(target, ns=(1700000000 * 10**9, 1700000000 * 10**9))
+
+    response, body = get(server, "/data.bin", If_None_Match=tag)
+    assert response.status == 200
+    assert response.getheader("ETag") != tag
+    assert body.endswith(b"!")